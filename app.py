@@ -1,70 +1,2398 @@
 """WebApp Module"""
 
+import contextlib
+import csv
+import functools
+import hashlib
+import hmac
+import io
+import json
+import logging
+import math
 import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import tracemalloc
+import unicodedata
+from collections import OrderedDict
 from datetime import datetime
-from flask import Flask, request, jsonify
+from typing import Annotated, Literal, Optional
+import click
+import msgspec
+from flask import (
+    Flask, Response, abort, after_this_request, g, has_request_context, request,
+    jsonify, make_response, render_template, stream_template, stream_with_context,
+)
+from flask.cli import AppGroup
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
+from markupsafe import Markup
+from sqlalchemy import bindparam, delete, event, inspect, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet export is optional.
+    pa = pq = None
+
+try:
+    import cbor2
+except ImportError:  # CBOR responses are optional; MessagePack is always offered.
+    cbor2 = None
 
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(basedir, "main.db")
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app = Flask(__name__)
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+    "DATABASE_URL", "sqlite:///" + os.path.join(basedir, "main.db"))
+app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    # SQLAlchemy's compiled statement cache, shared by every query shape.
+    "query_cache_size": 1200,
+    # sqlite3's per-connection prepared statement cache (default 128).
+    "connect_args": {"cached_statements": 512},
+}
+app.config["MAX_CONTENT_LENGTH"] = 1024 * 1024
+# "memory" keeps idempotency keys per process; "sqlite" shares them between
+# workers, and is what a multi-worker `flask serve` uses unless this is set.
+app.config["IDEMPOTENCY_BACKEND"] = os.environ.get("IDEMPOTENCY_BACKEND", "memory")
+app.config["IDEMPOTENCY_TTL"] = 24 * 60 * 60
+app.config["IDEMPOTENCY_MAX_KEYS"] = 10000
+# Profiling hooks stay disabled unless a token is configured.
+app.config["PROFILING_TOKEN"] = os.environ.get("PROFILING_TOKEN")
+# Per-process admission control; lanes are configured below ADMISSION_LANES.
+app.config["ADMISSION_CONTROL"] = os.environ.get("ADMISSION_CONTROL", "1") != "0"
+# Job worker threads started inside each `flask serve` worker and by
+# `python app.py`; 0 leaves the queue to a separate `flask jobs work`.
+app.config["JOB_WORKER_THREADS"] = int(os.environ.get("JOB_WORKER_THREADS", 1))
+# Fraction of requests appended to REQUEST_CAPTURE_PATH for later replay;
+# 0 disables capture.
+app.config["REQUEST_CAPTURE_RATE"] = float(os.environ.get("REQUEST_CAPTURE_RATE", 0))
+app.config["REQUEST_CAPTURE_PATH"] = os.environ.get(
+    "REQUEST_CAPTURE_PATH", os.path.join(basedir, "capture.ndjson"))
+app.config["EMAIL_FILTER_CAPACITY"] = int(
+    os.environ.get("EMAIL_FILTER_CAPACITY", 1000000))
+app.config["EMAIL_FILTER_ERROR_RATE"] = float(
+    os.environ.get("EMAIL_FILTER_ERROR_RATE", 0.01))
+
+db = SQLAlchemy(app)
+
+users_cli = AppGroup("users", help="User table maintenance commands.")
+app.cli.add_command(users_cli)
+newsletter_cli = AppGroup("newsletter", help="Newsletter delivery commands.")
+app.cli.add_command(newsletter_cli)
+schema_cli = AppGroup("schema", help="Schema migration commands.")
+app.cli.add_command(schema_cli)
+jobs_cli = AppGroup("jobs", help="Background job queue commands.")
+app.cli.add_command(jobs_cli)
+backup_cli = AppGroup("backup", help="Online database backup commands.")
+app.cli.add_command(backup_cli)
+
+EXPORT_COLUMNS = (
+    "user_id", "first_name", "last_name", "email", "newsletter",
+    "subscription_id", "created", "updated_at", "deleted", "change_seq",
+)
+EXPORT_BATCH_SIZE = 1000
+PARQUET_ROW_GROUP_SIZE = 64 * 1024
+IMPORT_FIELDS = ("first_name", "last_name", "email", "password")
+IMPORT_BATCH_SIZE = 5000
+IMPORT_COMMIT_EVERY = 100000
+# Stay under SQLITE_MAX_VARIABLE_NUMBER on older SQLite builds.
+SQLITE_MAX_PARAMS = 900
+# A coarse guard against oversized bodies; msgspec's max_length=255 enforces
+# the real field limits. Four 255-character fields escaped as \uXXXX (6 bytes
+# per character) plus JSON syntax come to about 6.2 KB.
+USER_PAYLOAD_MAX_BYTES = 8192
+USER_BATCH_MAX_IDS = 1000
+BATCH_MAX_OPERATIONS = 1000
+# name: (concurrency limit, queue delay target, CoDel interval, max wait,
+# max waiting requests); times in seconds.
+ADMISSION_LANES = {
+    "cheap": (64, 0.005, 0.1, 0.5, 256),
+    "write": (4, 0.02, 0.1, 1.0, 8),
+    # Reads of up to a few thousand rows, bounded by a limit or id list.
+    "bulk": (8, 0.01, 0.1, 1.0, 16),
+    "scan": (2, 0.05, 0.5, 2.0, 2),
+}
+# Server threads per worker kept out of reach of the write and scan lanes.
+ADMISSION_RESERVED_THREADS = 1
+# Endpoints not listed here run in the cheap lane; None bypasses admission.
+ADMISSION_ROUTES = {
+    "users": "scan",
+    "export_users": "scan",
+    "users_batch": "bulk",
+    "user_changes": "bulk",
+    "newsletter_recipients": "bulk",
+    "similar": "bulk",
+    "create_user": "write",
+    "update_user": "write",
+    "delete_user": "write",
+    "batch": "write",
+    "profile_cpu": None,
+    "profile_memory": None,
+    "admission_stats": None,
+    "static": None,
+}
+ADMISSION_RETRY_AFTER = 1
+PROFILE_SAMPLE_INTERVAL = 0.005
+# Single requests are short, so they are sampled more densely.
+PROFILE_REQUEST_SAMPLE_INTERVAL = 0.001
+PROFILE_MAX_SECONDS = 60
+PROFILE_MAX_FRAMES = 64
+PROFILE_MAX_TOP = 500
+CAPTURE_HEADERS = ("Accept", "Content-Type", "Idempotency-Key")
+CAPTURE_MAX_BODY = 64 * 1024
+# Endpoints whose bodies may carry passwords; those are only kept once redacted.
+CAPTURE_PRIVATE_ENDPOINTS = ("create_user", "update_user", "batch")
+# How long an in-flight idempotent request blocks retries before it is presumed dead.
+IDEMPOTENCY_PENDING_TIMEOUT = 60
+USER_FRAGMENT_CACHE_SIZE = 10000
+MIGRATION_BATCH_SIZE = 500
+SERVE_THREADS_PER_CORE = 4
+JOB_BATCH_SIZE = 100
+JOB_MAX_ATTEMPTS = 8
+JOB_LEASE_SECONDS = 300
+JOB_POLL_INTERVAL = 1.0
+JOB_MAX_BACKOFF = 3600
+BACKUP_DIR = os.path.join(basedir, "backups")
+BACKUP_KEEP = 7
+ONLINE_REBUILD_THRESHOLD = 100000
+# MinHash signatures are split into bands of rows; two users become
+# candidates when any band matches, which is likely above a Jaccard
+# similarity of about (1 / bands) ** (1 / rows), here 0.4.
+SIMILARITY_BANDS = 16
+SIMILARITY_ROWS = 3
+SIMILARITY_THRESHOLD = 0.5
+SIMILARITY_MAX_CANDIDATES = 200
+SIMILARITY_SHINGLE_CACHE = 1 << 16
+SUBSCRIPTION_CACHE_TTL = 300
+NEWSLETTER_CHUNK_SIZE = 1000
+NEWSLETTER_MAX_CHUNK_SIZE = 10000
+# Sort keys accepted by /users/, with their tie-breakers and backing index.
+USER_SORTS = {
+    "created": (("created",), "ix_User_deleted_created"),
+    "last_name": (("last_name", "first_name"), "ix_User_deleted_last_name"),
+    "first_name": (("first_name", "last_name"), "ix_User_deleted_first_name"),
+}
+CARD_COLUMNS = ("user_id", "first_name", "last_name", "email", "created", "change_seq")
+
+def is_json(expression):
+    """Determine if a string is in JSON format."""
+    return str(type(expression)) == "<class 'dict'>"
+
+
+ShortText = Annotated[str, msgspec.Meta(min_length=1, max_length=255)]
+
+
+class UserPayload(msgspec.Struct):
+    """Request body of the create and update user endpoints."""
+    first_name: ShortText
+    last_name: ShortText
+    email: ShortText
+    password: ShortText
+
+
+user_payload_decoder = msgspec.json.Decoder(UserPayload)
+
+
+class UserIdsPayload(msgspec.Struct):
+    """Request body of the batch user lookup."""
+    ids: Annotated[list[int], msgspec.Meta(max_length=USER_BATCH_MAX_IDS)]
+
+
+user_ids_decoder = msgspec.json.Decoder(UserIdsPayload)
+
+
+class BatchOperation(msgspec.Struct):
+    """One create, update or delete inside a batch request."""
+    op: Literal["create", "update", "delete"]
+    user_id: Optional[int] = None
+    data: Optional[UserPayload] = None
+
+
+class BatchPayload(msgspec.Struct):
+    """Request body of the transactional batch endpoint."""
+    operations: Annotated[list[BatchOperation],
+                          msgspec.Meta(min_length=1, max_length=BATCH_MAX_OPERATIONS)]
+    mode: Literal["atomic", "continue"] = "atomic"
+
+
+batch_payload_decoder = msgspec.json.Decoder(BatchPayload)
+
+
+def decode_user_payload():
+    """Decode and validate the request body as a UserPayload in one pass."""
+    if (request.content_length or 0) > USER_PAYLOAD_MAX_BYTES:
+        raise msgspec.ValidationError("Request body is too large.")
+    body = request.get_data()
+    if len(body) > USER_PAYLOAD_MAX_BYTES:
+        raise msgspec.ValidationError("Request body is too large.")
+    return user_payload_decoder.decode(body)
+
+
+class FragmentCache:
+    """
+    Bounded LRU of rendered HTML fragments.
+    Entries are keyed by user id and tagged with the user's change_seq,
+    so a fragment rendered before a write is never served after it.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id, change_seq):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or entry[0] != change_seq:
+                return None
+            self.entries.move_to_end(user_id)
+            return entry[1]
+
+    def set(self, user_id, change_seq, fragment):
+        with self.lock:
+            self.entries[user_id] = (change_seq, fragment)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+
+user_fragments = FragmentCache(USER_FRAGMENT_CACHE_SIZE)
+
+
+class BloomFilter:
+    """
+    Bloom filter of registered emails.
+    A miss means the email is definitely not registered in this process's
+    view; a hit still has to be confirmed against the database. Emails
+    registered by other workers are caught by the UNIQUE(email) index.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self.loaded = False
+        self.stats = {"checks": 0, "definite_misses": 0, "lookups": 0,
+                      "false_positives": 0}
+        self.lock = threading.Lock()
+
+    def positions(self, value):
+        """Bit positions for a value, by double hashing one digest."""
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, value):
+        with self.lock:
+            for position in self.positions(value):
+                self.bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def might_contain(self, value):
+        found = all(self.bits[position >> 3] & (1 << (position & 7))
+                    for position in self.positions(value))
+        with self.lock:
+            self.stats["checks"] += 1
+            if not found:
+                self.stats["definite_misses"] += 1
+        return found
+
+    def record_lookup(self, found):
+        """Account for a database lookup made after a filter hit."""
+        with self.lock:
+            self.stats["lookups"] += 1
+            if not found:
+                self.stats["false_positives"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.bits = bytearray(len(self.bits))
+            self.count = 0
+
+    @property
+    def serialize(self):
+        """Return filter settings and counters in easily serializable format"""
+        estimated = (1 - math.exp(-self.hash_count * self.count / self.size)) \
+            ** self.hash_count
+        return {
+            "capacity": self.capacity,
+            "error_rate": self.error_rate,
+            "size_bits": self.size,
+            "hash_count": self.hash_count,
+            "loaded": self.loaded,
+            "emails": self.count,
+            "estimated_error_rate": estimated,
+            **self.stats,
+        }
+
+
+email_filter = BloomFilter(
+    app.config["EMAIL_FILTER_CAPACITY"], app.config["EMAIL_FILTER_ERROR_RATE"])
+
+
+@functools.lru_cache(maxsize=SIMILARITY_SHINGLE_CACHE)
+def normalize_name(value):
+    """Lowercase, strip accents and keep only letters, digits and single spaces."""
+    decomposed = unicodedata.normalize("NFKD", value.lower())
+    kept = "".join(char if char.isalnum() else " " for char in decomposed
+                   if not unicodedata.combining(char))
+    return " ".join(kept.split())
+
+
+def similarity_shingles(first_name, last_name, email):
+    """
+    Character trigrams of the full name and of the email's local part, plus
+    the domain as one token. The local part drops +tags and punctuation, so
+    jane.doe+promo@ and janedoe@ read the same.
+    """
+    name = f" {normalize_name(first_name)} {normalize_name(last_name)} "
+    local, _, domain = email.lower().partition("@")
+    local = "".join(char for char in local.split("+", 1)[0] if char.isalnum())
+    local = f" {local} "
+    shingles = {"n" + name[i:i + 3] for i in range(len(name) - 2)}
+    shingles.update("e" + local[i:i + 3] for i in range(len(local) - 2))
+    shingles.add("d" + domain)
+    return shingles
+
+
+def jaccard(first, second):
+    """Jaccard similarity of two shingle sets."""
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+MINHASH_SLOTS = SIMILARITY_BANDS * SIMILARITY_ROWS
+
+
+def stable_hash(value):
+    """64-bit hash that, unlike hash(), is the same in every process."""
+    return int.from_bytes(
+        hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+# Band keys are stored, so the probe order must never change.
+DENSIFY_PROBES = [sorted((other for other in range(MINHASH_SLOTS) if other != slot),
+                         key=lambda other, slot=slot: stable_hash(f"{slot}:{other}"))
+                  for slot in range(MINHASH_SLOTS)]
+
+
+@functools.lru_cache(maxsize=SIMILARITY_SHINGLE_CACHE)
+def shingle_hash(shingle):
+    """Names and emails reuse a small alphabet of trigrams, so nearly every
+    call is a cache hit."""
+    return stable_hash(shingle)
+
+
+def similarity_bands(shingles):
+    """
+    LSH band keys of a shingle set, as signed 64-bit integers for SQLite.
+    The signature is a one-permutation MinHash: each shingle's hash lands in
+    one of MINHASH_SLOTS slots and each slot keeps its minimum, so it costs
+    one hash per shingle instead of one per shingle and slot. Empty slots
+    borrow from the first filled slot in a fixed probe order (optimal
+    densification), which keeps P(slots match) equal to the Jaccard similarity.
+    """
+    signature = [None] * MINHASH_SLOTS
+    for value in map(shingle_hash, shingles):
+        slot = value % MINHASH_SLOTS
+        if signature[slot] is None or value < signature[slot]:
+            signature[slot] = value
+    dense = signature[:]
+    for slot, value in enumerate(signature):
+        if value is None:
+            for other in DENSIFY_PROBES[slot]:
+                if signature[other] is not None:
+                    dense[slot] = signature[other]
+                    break
+    keys = []
+    for band in range(SIMILARITY_BANDS):
+        key = band
+        for value in dense[band * SIMILARITY_ROWS:(band + 1) * SIMILARITY_ROWS]:
+            key = (key * 0x100000001B3 ^ value) & 0xFFFFFFFFFFFFFFFF
+        keys.append(key - (1 << 64) if key >> 63 else key)
+    return keys
+
+
+def dump_datetime(value):
+    """Deserialize datetime object into string form for JSON processing."""
+    if value is None:
+        return None
+    return [value.strftime("%Y-%m-%d"), value.strftime("%H:%M:%S")]
+
+
+def aware_datetime(value):
+    """Attach the local timezone to a naive datetime read back from SQLite, so
+    binary formats can encode it as a native timestamp."""
+    if value is None or value.tzinfo is not None:
+        return value
+    return value.astimezone()
+
+
+msgpack_encoder = msgspec.msgpack.Encoder()
+BINARY_ENCODERS = {
+    "application/msgpack": msgpack_encoder.encode,
+    "application/x-msgpack": msgpack_encoder.encode,
+}
+BINARY_DECODERS = {
+    "application/msgpack": msgspec.msgpack.decode,
+    "application/x-msgpack": msgspec.msgpack.decode,
+}
+if cbor2 is not None:
+    BINARY_ENCODERS["application/cbor"] = functools.partial(
+        cbor2.dumps, datetime_as_timestamp=True)
+    BINARY_DECODERS["application/cbor"] = cbor2.loads
+RESPONSE_MIMETYPES = ["application/json", *BINARY_ENCODERS]
+
+
+def negotiated_mimetype():
+    """The response encoding the current request's Accept header prefers."""
+    return request.accept_mimetypes.best_match(RESPONSE_MIMETYPES) or "application/json"
+
+
+def reencode_body(body, mimetype, wanted):
+    """Convert a stored response body between JSON and the binary encodings."""
+    if mimetype == wanted or {mimetype, wanted} - set(RESPONSE_MIMETYPES):
+        return body, mimetype
+    if mimetype == "application/json":
+        payload = json.loads(body)
+    else:
+        payload = BINARY_DECODERS[mimetype](body)
+    if wanted == "application/json":
+        return f"{app.json.dumps(payload, separators=(',', ':'))}\n".encode(), wanted
+    return BINARY_ENCODERS[wanted](payload), wanted
+
+
+class NegotiatingJSONProvider(DefaultJSONProvider):
+    """
+    Backs jsonify(). Clients that prefer MessagePack or CBOR in their Accept
+    header get the same payload in that encoding, with datetimes as native
+    timestamps; everyone else gets JSON, where datetimes keep the
+    dump_datetime() [date, time] form.
+    """
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, datetime):
+            return dump_datetime(o)
+        return DefaultJSONProvider.default(o)
+
+    def response(self, *args, **kwargs):
+        mimetype = negotiated_mimetype() if has_request_context() else None
+        if mimetype in BINARY_ENCODERS:
+            if args and kwargs:
+                raise TypeError("app.json.response() takes either args or kwargs, not both")
+            obj = kwargs or (args[0] if len(args) == 1 else list(args) or None)
+            response = self._app.response_class(BINARY_ENCODERS[mimetype](obj),
+                                                mimetype=mimetype)
+        else:
+            response = super().response(*args, **kwargs)
+        if has_request_context():
+            response.vary.add("Accept")
+        return response
+
+
+app.json = NegotiatingJSONProvider(app)
+
+
+def sqlite_timestamp(value):
+    """Format a datetime the way SQLAlchemy stores it in SQLite."""
+    return value.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+class User(db.Model):
+    """Data model for user accounts."""
+    __tablename__ = "User"
+    __table_args__ = (
+        # Covers the newsletter keyset walk without touching table rows.
+        db.Index("ix_User_newsletter", "newsletter", "deleted", "user_id",
+                 "email", "first_name"),
+        db.Index("ix_User_change_seq", "change_seq"),
+        # Date range filters and sorts on /users/ scan these in order.
+        db.Index("ix_User_deleted_created", "deleted", "created"),
+        db.Index("ix_User_deleted_last_name", "deleted", "last_name", "first_name"),
+        db.Index("ix_User_deleted_first_name", "deleted", "first_name", "last_name"),
+    )
+    user_id = db.Column("user_id", db.Integer, primary_key=True)
+    first_name = db.Column(db.String(255), nullable=False)
+    last_name = db.Column(db.String(255), nullable=False)
+    email = db.Column(db.String(255), unique=True, nullable=False)
+    password = db.Column(db.String(255), nullable=False)
+    newsletter = db.Column(db.Boolean, default=False, nullable=False)
+    subscription_id = db.Column(
+        db.Integer, db.ForeignKey("Subscription.subscription_id"),
+        default=1, nullable=False
+    )
+    created = db.Column(
+        db.DateTime(timezone=True), default=datetime.now, nullable=False
+    )
+    deleted = db.Column(db.Boolean, default=False, nullable=False)
+    updated_at = db.Column(
+        db.DateTime(timezone=True), default=datetime.now, nullable=False
+    )
+    change_seq = db.Column(db.Integer, default=0, nullable=False)
+    # serialize reads plans from the in-process PlanCache, so user loads
+    # don't join or query the Subscription table.
+    subscription = db.relationship("Subscription")
+
+    def __repr__(self):
+        return f"{self.first_name}, {self.last_name} > ({self.email})"
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializable format"""
+        return {
+            "user_id": self.user_id,
+            "first_name": self.first_name,
+            "last_name": self.last_name,
+            "email": self.email,
+            "created": aware_datetime(self.created),
+            "updated_at": aware_datetime(self.updated_at),
+            "subscription": subscription_plans.get(self.subscription_id),
+            "deleted": self.deleted
+            # This is an example how to deal with Many2Many relations
+            # 'many2many'  : self.serialize_many2many
+        }
+
+    @property
+    def serialize_many2many(self):
+        """
+        Return object's relations in easily serializable format.
+        NB! Calls many2many's serialize property.
+        """
+        return [item.serialize for item in self.many2many]
+
+
+class Subscription(db.Model):
+    """Data model for subscription plans."""
+    __tablename__ = "Subscription"
+    subscription_id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(255), unique=True, nullable=False)
+    monthly_price = db.Column(db.Numeric(10, 2), default=0, nullable=False)
+    created = db.Column(
+        db.DateTime(timezone=True), default=datetime.now, nullable=False
+    )
+
+    def __repr__(self):
+        return f"{self.name} ({self.monthly_price})"
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializable format"""
+        return {
+            "subscription_id": self.subscription_id,
+            "name": self.name,
+            "monthly_price": str(self.monthly_price),
+        }
+
+
+class PlanCache:
+    """
+    In-process copy of the Subscription table.
+    The whole table is loaded in one query and kept until it expires or a
+    plan is written; other workers pick up changes within the TTL.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.plans = None
+        self.loaded_at = 0.0
+        self.lock = threading.Lock()
+
+    def all(self):
+        with self.lock:
+            if self.plans is None or time.monotonic() - self.loaded_at > self.ttl:
+                self.plans = {
+                    plan.subscription_id: plan.serialize
+                    for plan in Subscription.query.order_by(Subscription.subscription_id)
+                }
+                self.loaded_at = time.monotonic()
+            return self.plans
+
+    def get(self, subscription_id):
+        return self.all().get(subscription_id)
+
+    def invalidate(self):
+        with self.lock:
+            self.plans = None
+
+
+subscription_plans = PlanCache(SUBSCRIPTION_CACHE_TTL)
+
+
+@event.listens_for(Subscription, "after_insert")
+@event.listens_for(Subscription, "after_update")
+@event.listens_for(Subscription, "after_delete")
+def subscription_written(mapper, connection, target):
+    """Drop cached plans whenever one changes."""
+    subscription_plans.invalidate()
+
+
+class UserChange(db.Model):
+    """Change feed entry, one row per write on the User table."""
+    __tablename__ = "UserChange"
+    __table_args__ = {"sqlite_autoincrement": True}
+    seq = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(16), nullable=False)
+    changed_at = db.Column(
+        db.DateTime(timezone=True), default=datetime.now, nullable=False
+    )
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializable format"""
+        return {
+            "seq": self.seq,
+            "op": self.op,
+            "user_id": self.user_id,
+            "changed_at": aware_datetime(self.changed_at),
+        }
+
+
+class UserSimilarityBand(db.Model):
+    """LSH bucket membership: one row per band of each live user's MinHash."""
+    __tablename__ = "UserSimilarityBand"
+    __table_args__ = (db.Index("ix_UserSimilarityBand_user_id", "user_id"),
+                      {"sqlite_with_rowid": False})
+    band_key = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+
+def index_user_similarity(connection, rows, replace=True):
+    """
+    Replace the LSH bands of (user_id, first_name, last_name, email, deleted)
+    rows; replace=False skips clearing old bands for users that have none yet.
+    Deleted users drop out of the index.
+    """
+    user_ids = [row[0] for row in rows] if replace else []
+    for start in range(0, len(user_ids), SQLITE_MAX_PARAMS):
+        chunk = user_ids[start:start + SQLITE_MAX_PARAMS]
+        connection.exec_driver_sql(
+            'DELETE FROM "UserSimilarityBand" WHERE user_id IN '
+            f'({", ".join("?" * len(chunk))})', tuple(chunk))
+    entries = [(key, user_id)
+               for user_id, first_name, last_name, email, deleted in rows if not deleted
+               for key in similarity_bands(
+                   similarity_shingles(first_name, last_name, email))]
+    # Inserting in key order touches each index page once per batch.
+    entries.sort()
+    if entries:
+        connection.exec_driver_sql(
+            'INSERT OR IGNORE INTO "UserSimilarityBand" (band_key, user_id) '
+            "VALUES (?, ?)", entries)
+
+
+class Job(db.Model):
+    """Queued side effect of a write, run later by a job worker."""
+    __tablename__ = "Job"
+    __table_args__ = (db.Index("ix_Job_status_run_at", "status", "run_at"),)
+    job_id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(16), default="queued", nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    run_at = db.Column(db.Float, nullable=False)
+    locked_until = db.Column(db.Float)
+    last_error = db.Column(db.Text)
+    created = db.Column(
+        db.DateTime(timezone=True), default=datetime.now, nullable=False
+    )
+
+
+def enqueue_job(connection, kind, payload):
+    """
+    Queue a job on the given connection, so it commits or rolls back
+    together with the write that caused it.
+    """
+    connection.execute(Job.__table__.insert().values(
+        kind=kind, payload=json.dumps(payload), status="queued", attempts=0,
+        run_at=time.time(), created=datetime.now()))
+
+
+def record_user_change(connection, target, op):
+    """
+    Append a change feed entry and stamp the user with its sequence.
+    Runs inside the flush, so the entry commits (or rolls back) with the write.
+    SQLite holds the write lock until commit, so sequences commit in order.
+    """
+    now = datetime.now()
+    seq = connection.execute(
+        UserChange.__table__.insert().values(
+            user_id=target.user_id, op=op, changed_at=now
+        )
+    ).inserted_primary_key[0]
+    connection.execute(
+        User.__table__.update()
+        .where(User.__table__.c.user_id == target.user_id)
+        .values(change_seq=seq, updated_at=now)
+    )
+    set_committed_value(target, "change_seq", seq)
+    set_committed_value(target, "updated_at", now)
+    user_fragments.invalidate(target.user_id)
+    state = inspect(target)
+    # The filter counts every add, so only new addresses go in.
+    if op == "insert" or state.attrs.email.history.has_changes():
+        email_filter.add(target.email)
+    if op != "update" or any(state.attrs[key].history.has_changes() for key
+                             in ("first_name", "last_name", "email", "deleted")):
+        index_user_similarity(connection, [(target.user_id, target.first_name,
+                                            target.last_name, target.email,
+                                            target.deleted)], replace=op != "insert")
+    enqueue_job(connection, "audit_log", {"user_id": target.user_id, "op": op,
+                                          "seq": seq})
+    if op == "insert" and target.newsletter:
+        enqueue_job(connection, "welcome_email", {"user_id": target.user_id,
+                                                  "email": target.email})
+
+
+@event.listens_for(User, "after_insert")
+def user_inserted(mapper, connection, target):
+    """Feed inserts into the change log."""
+    record_user_change(connection, target, "insert")
+
+
+@event.listens_for(User, "after_update")
+def user_updated(mapper, connection, target):
+    """Feed updates and soft deletes into the change log."""
+    state = inspect(target)
+    if not any(state.attrs[attr.key].history.has_changes()
+               for attr in mapper.column_attrs):
+        return
+    if state.attrs.deleted.history.added == [True]:
+        record_user_change(connection, target, "delete")
+    else:
+        record_user_change(connection, target, "update")
+
+
+class IdempotencyRecord(db.Model):
+    """Stored response for an Idempotency-Key, shared by all workers."""
+    __tablename__ = "IdempotencyKey"
+    key = db.Column(db.String(512), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)
+    mimetype = db.Column(db.String(255))
+    body = db.Column(db.LargeBinary)
+    expires_at = db.Column(db.Float, nullable=False, index=True)
+
+
+class SchemaMigration(db.Model):
+    """Progress of a schema migration: its next step and that step's checkpoint."""
+    __tablename__ = "SchemaMigration"
+    name = db.Column(db.String(255), primary_key=True)
+    step = db.Column(db.Integer, default=0, nullable=False)
+    checkpoint = db.Column(db.Integer, default=0, nullable=False)
+    completed_at = db.Column(db.DateTime(timezone=True))
+
+
+class MigrationConflict(RuntimeError):
+    """Raised when another runner advanced a migration underneath this one."""
+
+
+class SchemaNotReady(RuntimeError):
+    """Raised when mapped columns are missing until `flask schema migrate` runs."""
+
+
+class MigrationRunner:
+    """
+    Applies MIGRATIONS in order and records progress in SchemaMigration.
+    Each unit of work is a short BEGIN IMMEDIATE transaction that also
+    advances the step's checkpoint, so the write lock is held for one batch
+    at a time and an interrupted run resumes exactly where it stopped.
+    """
+
+    def __init__(self, batch_size=MIGRATION_BATCH_SIZE, throttle=0.0, echo=None):
+        self.batch_size = batch_size
+        self.throttle = throttle
+        self.echo = echo or (lambda message: None)
+        self.connection = None
+
+    def run(self, migrations):
+        with db.engine.connect() as connection:
+            self.connection = connection
+            for migration in migrations:
+                self.apply(migration)
+
+    def apply(self, migration):
+        state = self.state(migration.name)
+        if state is None:
+            with self.transaction():
+                self.execute('INSERT INTO "SchemaMigration" (name, step, checkpoint) '
+                             "VALUES (?, 0, 0)", (migration.name,))
+            state = self.state(migration.name)
+        if state.completed_at is not None:
+            return
+        for index in range(state.step, len(migration.steps)):
+            self.echo(f"{migration.name}: step {index + 1}/{len(migration.steps)}")
+            migration.steps[index].run(self, migration.name, index)
+            with self.transaction():
+                self.execute('UPDATE "SchemaMigration" SET step = ?, checkpoint = 0 '
+                             "WHERE name = ?", (index + 1, migration.name))
+        with self.transaction():
+            self.execute('UPDATE "SchemaMigration" SET completed_at = ? WHERE name = ?',
+                         (sqlite_timestamp(datetime.now()), migration.name))
+
+    def state(self, name):
+        return self.execute(
+            'SELECT step, checkpoint, completed_at FROM "SchemaMigration" WHERE name = ?',
+            (name,)).first()
+
+    def execute(self, sql, params=()):
+        return self.connection.exec_driver_sql(sql, params)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # pysqlite defers BEGIN until DML; take the write lock up front instead.
+        self.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.rollback()
+            raise
+        self.connection.commit()
+
+    def save_checkpoint(self, name, step, old, new):
+        """Advance a step's checkpoint inside the batch's own transaction."""
+        updated = self.execute(
+            'UPDATE "SchemaMigration" SET checkpoint = ? '
+            "WHERE name = ? AND step = ? AND checkpoint = ?",
+            (new, name, step, old)).rowcount
+        if not updated:
+            raise MigrationConflict(f"{name} was advanced by another runner.")
+
+    def window_end(self, table, low):
+        """Last rowid of the next batch after low, or None when the table is done."""
+        return self.execute(
+            f'SELECT MAX(rowid) FROM (SELECT rowid FROM "{table}" WHERE rowid > ? '
+            "ORDER BY rowid LIMIT ?)", (low, self.batch_size)).scalar()
+
+    def columns(self, table):
+        return [row[1] for row in self.execute(f'PRAGMA table_info("{table}")')]
+
+    def table_exists(self, table):
+        return self.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                            "AND name = ?", (table,)).first() is not None
+
+    def row_count(self, table):
+        return self.execute(f'SELECT COUNT(*) FROM "{table}"').scalar()
+
+    def rename_indexes(self, renames):
+        """
+        Rename indexes, {old name: new name}, inside the current transaction.
+        SQLite has no ALTER INDEX, but an index's name only lives in the
+        schema, so its entry is edited in place, as the SQLite docs allow for
+        changes that leave the stored pages alone. Bumping schema_version
+        makes other connections reload the schema.
+        """
+        version = self.execute("PRAGMA schema_version").scalar()
+        self.execute("PRAGMA writable_schema = ON")
+        for old, new in renames.items():
+            sql = self.execute("SELECT sql FROM sqlite_master WHERE type = 'index' "
+                               "AND name = ?", (old,)).scalar()
+            sql = INDEX_NAME.sub(lambda match: f'{match.group(1)}"{new}"', sql, 1)
+            self.execute("UPDATE sqlite_master SET name = ?, sql = ? "
+                         "WHERE type = 'index' AND name = ?", (new, sql, old))
+        self.execute(f"PRAGMA schema_version = {version + 1}")
+        self.execute("PRAGMA writable_schema = OFF")
+        self.execute("PRAGMA writable_schema = RESET")
+
+    def pause(self):
+        if self.throttle:
+            time.sleep(self.throttle)
+
+
+# The name in an index's CREATE statement, as stored in sqlite_master.
+INDEX_NAME = re.compile(r'^(CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:IF\s+NOT\s+EXISTS\s+)?)'
+                        r'("[^"]*"|\S+)', re.IGNORECASE)
+
+
+class Migration:
+    """A named, ordered list of steps applied at most once."""
+
+    def __init__(self, name, steps):
+        self.name = name
+        self.steps = steps
+
+
+class AddColumn:
+    """ALTER TABLE ADD COLUMN, which SQLite applies without touching rows."""
+
+    def __init__(self, table, column, ddl):
+        self.table = table
+        self.column = column
+        self.ddl = ddl
+
+    def run(self, runner, name, index):
+        with runner.transaction():
+            self.add(runner.connection)
+
+    def add(self, connection):
+        """Add the column unless it exists; safe to repeat, and instant."""
+        columns = [row[1] for row in connection.exec_driver_sql(
+            f'PRAGMA table_info("{self.table}")')]
+        if self.column not in columns:
+            connection.exec_driver_sql(
+                f'ALTER TABLE "{self.table}" ADD COLUMN {self.column} {self.ddl}')
+
+
+class Backfill:
+    """
+    Calls apply(connection, low, high) on successive rowid windows of a
+    table, one transaction and checkpoint per window. apply receives an
+    exclusive lower and inclusive upper bound.
+    """
+
+    def __init__(self, table, apply, skip_if=None):
+        self.table = table
+        self.apply = apply
+        self.skip_if = skip_if
+
+    def run(self, runner, name, index):
+        checkpoint = runner.state(name).checkpoint
+        if checkpoint == 0 and self.skip_if and self.skip_if(runner):
+            return
+        while True:
+            with runner.transaction():
+                high = runner.window_end(self.table, checkpoint)
+                if high is not None:
+                    self.apply(runner.connection, checkpoint, high)
+                    runner.save_checkpoint(name, index, checkpoint, high)
+            if high is None:
+                return
+            checkpoint = high
+            runner.pause()
+
+
+class RebuildTable:
+    """
+    Online rebuild of a table to its model definition.
+    The table is copied in rowid batches into a new table. Triggers mirror
+    concurrent writes into the copy. The copy is then swapped in with two
+    instant renames, and the old rows are deleted in batches. The copy is
+    built with the model's indexes under temporary names, so the live
+    table keeps serving from its own until the swap renames both sets.
+    renames maps new column names onto old ones.
+    """
+
+    def __init__(self, table, renames=None, when=None):
+        self.table = table
+        self.renames = renames or {}
+        self.when = when
+
+    def run(self, runner, name, index):
+        old = self.table.name
+        new, retired = f"{old}__rebuild", f"{old}__retired"
+        if not runner.table_exists(new):
+            # Either a resumed run already swapped, or there is nothing to do.
+            if (runner.table_exists(retired)
+                    or (self.when and not self.when(runner.columns(old)))):
+                self.drop_retired(runner, retired)
+                return
+            self.start(runner, old, new, name, index)
+        self.copy(runner, old, new, name, index)
+        with runner.transaction():
+            for suffix in ("ai", "au", "ad"):
+                runner.execute(f'DROP TRIGGER IF EXISTS "{new}_{suffix}"')
+            # Keep other tables' foreign keys pointing at the name, not the table.
+            runner.execute("PRAGMA legacy_alter_table = ON")
+            runner.execute(f'ALTER TABLE "{old}" RENAME TO "{retired}"')
+            runner.execute(f'ALTER TABLE "{new}" RENAME TO "{old}"')
+            renames = {}
+            for index_name, table_name in runner.execute(
+                    "SELECT name, tbl_name FROM sqlite_master WHERE type = 'index' "
+                    "AND tbl_name IN (?, ?) AND sql IS NOT NULL", (old, retired)).all():
+                if table_name == retired:
+                    renames[index_name] = f"{index_name}__retired"
+                elif index_name.endswith("__rebuild"):
+                    renames[index_name] = index_name.removesuffix("__rebuild")
+            runner.rename_indexes(renames)
+        runner.execute("PRAGMA legacy_alter_table = OFF")
+        self.drop_retired(runner, retired)
+
+    def mapping(self, runner, old):
+        existing = runner.columns(old)
+        mapping = {}
+        for column in self.table.columns:
+            source = self.renames.get(column.name, column.name)
+            if source not in existing:
+                raise RuntimeError(f"No source column for {old}.{column.name}.")
+            mapping[column.name] = source
+        return mapping
+
+    def start(self, runner, old, new, name, index):
+        mapping = self.mapping(runner, old)
+        targets = ", ".join(f'"{column}"' for column in mapping)
+        values = ", ".join(f'NEW."{source}"' for source in mapping.values())
+        scratch = db.MetaData()
+        for key in self.table.foreign_keys:
+            key.column.table.to_metadata(scratch)
+        copy = self.table.to_metadata(scratch, name=new)
+        # Index names are global, and the live table's keep theirs until the swap.
+        for item in copy.indexes:
+            item.name = f"{item.name}__rebuild"
+        with runner.transaction():
+            copy.create(runner.connection)
+            for event_name, suffix in (("INSERT", "ai"), ("UPDATE", "au")):
+                runner.execute(
+                    f'CREATE TRIGGER "{new}_{suffix}" AFTER {event_name} ON "{old}" '
+                    f'BEGIN INSERT OR REPLACE INTO "{new}" ({targets}) '
+                    f"VALUES ({values}); END")
+            runner.execute(
+                f'CREATE TRIGGER "{new}_ad" AFTER DELETE ON "{old}" '
+                f'BEGIN DELETE FROM "{new}" WHERE rowid = OLD.rowid; END')
+            runner.execute('UPDATE "SchemaMigration" SET checkpoint = 0 '
+                           "WHERE name = ? AND step = ?", (name, index))
+
+    def copy(self, runner, old, new, name, index):
+        mapping = self.mapping(runner, old)
+        targets = ", ".join(f'"{column}"' for column in mapping)
+        sources = ", ".join(f'"{source}"' for source in mapping.values())
+        checkpoint = runner.state(name).checkpoint
+        # Rows inserted from here on are mirrored by the triggers; stopping at
+        # this bound keeps a steady stream of inserts from extending the copy.
+        last = runner.execute(f'SELECT MAX(rowid) FROM "{old}"').scalar() or 0
+        while True:
+            with runner.transaction():
+                high = runner.window_end(old, checkpoint) if checkpoint < last else None
+                if high is not None:
+                    high = min(high, last)
+                    # Rows the triggers already mirrored are newer; keep them.
+                    runner.execute(
+                        f'INSERT OR IGNORE INTO "{new}" ({targets}) SELECT {sources} '
+                        f'FROM "{old}" WHERE rowid > ? AND rowid <= ?',
+                        (checkpoint, high))
+                    runner.save_checkpoint(name, index, checkpoint, high)
+            if high is None:
+                return
+            checkpoint = high
+            runner.pause()
+
+    @staticmethod
+    def drop_retired(runner, retired):
+        # Without its indexes the retired table's rows delete faster.
+        for (index_name,) in runner.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' "
+                "AND tbl_name = ? AND sql IS NOT NULL", (retired,)).all():
+            with runner.transaction():
+                runner.execute(f'DROP INDEX "{index_name}"')
+        while runner.table_exists(retired):
+            with runner.transaction():
+                deleted = runner.execute(
+                    f'DELETE FROM "{retired}" WHERE rowid IN '
+                    f'(SELECT rowid FROM "{retired}" LIMIT ?)',
+                    (runner.batch_size,)).rowcount
+                if not deleted:
+                    runner.execute(f'DROP TABLE "{retired}"')
+            runner.pause()
+
+
+class EnsureIndexes:
+    """
+    Create the model's missing indexes. Small tables get a plain CREATE
+    INDEX; above ONLINE_REBUILD_THRESHOLD rows that would hold the write
+    lock for too long, so the table is rebuilt online instead.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def run(self, runner, name, index):
+        existing = {row[0] for row in runner.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?",
+            (self.table.name,))}
+        missing = [item for item in self.table.indexes if item.name not in existing]
+        if not missing:
+            return
+        if runner.row_count(self.table.name) > ONLINE_REBUILD_THRESHOLD:
+            RebuildTable(self.table).run(runner, name, index)
+            return
+        with runner.transaction():
+            for item in missing:
+                item.create(runner.connection)
+
+
+def backfill_updated_at(connection, low, high):
+    """Start updated_at out equal to created."""
+    connection.exec_driver_sql(
+        'UPDATE "User" SET updated_at = created '
+        "WHERE user_id > ? AND user_id <= ? AND updated_at IS NULL", (low, high))
+
+
+def seed_change_feed(connection, low, high):
+    """Give existing users an insert entry so a sync from zero sees them."""
+    base = connection.exec_driver_sql(
+        'SELECT COALESCE(MAX(seq), 0) FROM "UserChange"').scalar()
+    connection.exec_driver_sql(
+        'INSERT INTO "UserChange" (user_id, op, changed_at) '
+        "SELECT user_id, 'insert', COALESCE(updated_at, created) FROM \"User\" "
+        "WHERE user_id > ? AND user_id <= ? ORDER BY user_id", (low, high))
+    connection.exec_driver_sql(
+        'UPDATE "User" SET change_seq = c.seq FROM "UserChange" AS c '
+        'WHERE c.seq > ? AND c.user_id = "User".user_id', (base,))
+
+
+def backfill_similarity_bands(connection, low, high):
+    """Index existing users for near-duplicate lookups."""
+    rows = connection.exec_driver_sql(
+        'SELECT user_id, first_name, last_name, email, deleted FROM "User" '
+        "WHERE user_id > ? AND user_id <= ?", (low, high)).all()
+    index_user_similarity(connection, rows)
+
+
+MIGRATIONS = [
+    Migration("0001_user_change_tracking", [
+        AddColumn("User", "updated_at", "DATETIME"),
+        AddColumn("User", "change_seq", "INTEGER NOT NULL DEFAULT 0"),
+        Backfill("User", backfill_updated_at),
+        # Databases upgraded before the runner existed are already seeded.
+        Backfill("User", seed_change_feed, skip_if=lambda runner: runner.execute(
+            'SELECT 1 FROM "UserChange" LIMIT 1').first() is not None),
+    ]),
+    # Some early databases spelled the column suscription_id.
+    Migration("0002_user_subscription_id", [
+        RebuildTable(User.__table__, renames={"subscription_id": "suscription_id"},
+                     when=lambda columns: "suscription_id" in columns),
+    ]),
+    Migration("0003_user_indexes", [EnsureIndexes(User.__table__)]),
+    Migration("0004_user_similarity_bands", [
+        Backfill("User", backfill_similarity_bands),
+    ]),
+]
+
+
+def pending_migrations():
+    """Names of MIGRATIONS that have not completed, in order."""
+    applied = set(db.session.execute(
+        select(SchemaMigration.name).where(SchemaMigration.completed_at.isnot(None))
+    ).scalars())
+    return [migration.name for migration in MIGRATIONS if migration.name not in applied]
+
+
+def prepare_schema():
+    """
+    Put the database in WAL mode, create missing tables, add missing
+    columns and seed the default plan. Adding a column only rewrites the
+    schema, so pending AddColumn steps are applied here; backfills and
+    rebuilds touch every row and are left to `flask schema migrate`.
+    A new database already has the current schema and is marked migrated.
+    Returns the mapped columns that are still missing.
+    """
+    with db.engine.connect() as connection:
+        # Persistent: readers, backups included, no longer block writers.
+        connection.exec_driver_sql("PRAGMA journal_mode = WAL")
+        # Processes starting together on a new database take turns here.
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+        fresh = not inspect(connection).has_table(User.__tablename__)
+        db.metadata.create_all(connection)
+        if fresh:
+            now = datetime.now()
+            connection.execute(SchemaMigration.__table__.insert(), [
+                {"name": migration.name, "step": len(migration.steps),
+                 "checkpoint": 0, "completed_at": now}
+                for migration in MIGRATIONS])
+        for migration in MIGRATIONS:
+            for step in migration.steps:
+                if isinstance(step, AddColumn):
+                    step.add(connection)
+        # Every existing user points at plan 1, the column default.
+        connection.execute(sqlite_insert(Subscription).values(
+            subscription_id=1, name="Free", monthly_price=0).on_conflict_do_nothing())
+        connection.commit()
+        inspector = inspect(connection)
+        missing = []
+        for table in db.metadata.sorted_tables:
+            live = {column["name"] for column in inspector.get_columns(table.name)}
+            missing += [f"{table.name}.{column.name}" for column in table.columns
+                        if column.name not in live]
+    return missing
+
+
+schema_lock = threading.Lock()
+schema_prepared = False
+
+
+def ensure_schema():
+    """
+    Prepare the schema once per process, before its first request or
+    database command; importing the app never touches the database.
+    """
+    global schema_prepared
+    if not schema_prepared:
+        with schema_lock:
+            if not schema_prepared:
+                missing = prepare_schema()
+                if missing:
+                    raise SchemaNotReady(
+                        f"Missing columns {', '.join(missing)}; run `flask schema "
+                        "migrate` before serving.")
+                pending = pending_migrations()
+                if pending:
+                    app.logger.warning("Pending schema migrations: %s. Run `flask "
+                                       "schema migrate` to apply them.",
+                                       ", ".join(pending))
+                schema_prepared = True
+
+
+def requires_schema(command):
+    """Prepare the schema before a command that reads or writes the tables."""
+    @functools.wraps(command)
+    def wrapper(*args, **kwargs):
+        try:
+            ensure_schema()
+        except SchemaNotReady as error:
+            raise click.ClickException(str(error)) from error
+        return command(*args, **kwargs)
+    return wrapper
+
+
+@schema_cli.command("migrate")
+@click.option("--batch-size", default=MIGRATION_BATCH_SIZE, show_default=True,
+              help="Rows per transaction.")
+@click.option("--throttle", default=0.01, show_default=True,
+              help="Seconds to sleep between batches, leaving the lock to the app.")
+def migrate_command(batch_size, throttle):
+    """Apply pending schema migrations in small, resumable batches."""
+    prepare_schema()
+    MigrationRunner(batch_size, throttle, click.echo).run(MIGRATIONS)
+    click.echo("Schema is up to date.")
+
+
+@schema_cli.command("status")
+def schema_status_command():
+    """Show each migration's progress."""
+    prepare_schema()
+    runner = MigrationRunner()
+    with db.engine.connect() as connection:
+        runner.connection = connection
+        for migration in MIGRATIONS:
+            state = runner.state(migration.name)
+            if state is None:
+                status = "pending"
+            elif state.completed_at:
+                status = f"applied {state.completed_at}"
+            else:
+                status = (f"step {state.step + 1}/{len(migration.steps)}, "
+                          f"checkpoint {state.checkpoint}")
+            click.echo(f"{migration.name}: {status}")
+
+
+@schema_cli.command("rebuild")
+@click.argument("table_name")
+@click.option("--batch-size", default=MIGRATION_BATCH_SIZE, show_default=True)
+@click.option("--throttle", default=0.01, show_default=True)
+def rebuild_command(table_name, batch_size, throttle):
+    """Rebuild a table online to its model definition, e.g. to add indexes."""
+    table = db.metadata.tables.get(table_name)
+    if table is None:
+        raise click.BadParameter(f"Unknown table {table_name}.")
+    name = f"rebuild_{table_name}"
+    prepare_schema()
+    runner = MigrationRunner(batch_size, throttle, click.echo)
+    runner.run([Migration(name, [RebuildTable(table)])])
+    with db.engine.begin() as connection:
+        # Forget the run so the table can be rebuilt again later.
+        connection.exec_driver_sql('DELETE FROM "SchemaMigration" WHERE name = ?',
+                                   (name,))
+    click.echo(f"Rebuilt {table_name}.")
+
+
+def build_email_filter():
+    """Load every registered email, including deleted users', into the filter."""
+    table = User.__table__
+    email_filter.clear()
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(table.c.user_id, table.c.email).where(table.c.user_id > last_id)
+            .order_by(table.c.user_id).limit(EXPORT_BATCH_SIZE)).all()
+        if not rows:
+            break
+        for row in rows:
+            email_filter.add(row.email)
+        last_id = rows[-1].user_id
+    email_filter.loaded = True
+
+
+email_filter_build_lock = threading.Lock()
+
+
+def ensure_email_filter():
+    """
+    Build the filter on first use, so commands that never check an email
+    skip the full-table scan. `flask serve` builds it before forking.
+    """
+    if not email_filter.loaded:
+        with email_filter_build_lock:
+            if not email_filter.loaded:
+                build_email_filter()
+
+
+# Hot point lookups are built once at import. Their cache key is memoized on
+# the statement, so each call skips straight to the compiled SQL and only
+# binds values; rebuilding a Query per call costs about twice as much.
+USER_BY_ID = select(User).where(User.user_id == bindparam("user_id"))
+USERS_BY_IDS = select(User).where(
+    User.user_id.in_(bindparam("user_ids", expanding=True)))
+USER_ID_BY_EMAIL = select(User.user_id).where(User.email == bindparam("email")).limit(1)
+
+
+SIMILAR_CANDIDATES = (
+    select(UserSimilarityBand.user_id)
+    .where(UserSimilarityBand.band_key.in_(bindparam("band_keys", expanding=True)),
+           UserSimilarityBand.user_id != bindparam("user_id"))
+    .group_by(UserSimilarityBand.user_id)
+    .order_by(db.func.count().desc(), UserSimilarityBand.user_id)
+    .limit(bindparam("limit")))
+
+
+def user_by_id(user_id):
+    """Look a user up by primary key."""
+    return db.session.execute(USER_BY_ID, {"user_id": user_id}).scalar_one_or_none()
+
+
+def users_by_ids(user_ids):
+    """Look several users up with one IN query."""
+    return db.session.execute(USERS_BY_IDS, {"user_ids": user_ids}).scalars()
+
+
+def user_id_by_email(email):
+    """Return the id registered with an email, or None."""
+    return db.session.execute(USER_ID_BY_EMAIL, {"email": email}).scalar_one_or_none()
+
+
+def email_registered(email):
+    """Check the email filter first; only a possible hit queries the database."""
+    ensure_email_filter()
+    if not email_filter.might_contain(email):
+        return False
+    found = user_id_by_email(email) is not None
+    email_filter.record_lookup(found)
+    return found
+
+
+def similar_users(user_record, threshold=SIMILARITY_THRESHOLD, limit=None):
+    """
+    Live users whose names and email look like user_record's, as
+    (score, user) pairs, best first. Candidates come from the LSH buckets the
+    user falls in, so only they are scored, never the whole table.
+    """
+    shingles = similarity_shingles(user_record.first_name, user_record.last_name,
+                                   user_record.email)
+    candidate_ids = db.session.execute(SIMILAR_CANDIDATES, {
+        "band_keys": similarity_bands(shingles), "user_id": user_record.user_id,
+        "limit": SIMILARITY_MAX_CANDIDATES}).scalars().all()
+    matches = []
+    for candidate in users_by_ids(candidate_ids) if candidate_ids else []:
+        score = jaccard(shingles, similarity_shingles(
+            candidate.first_name, candidate.last_name, candidate.email))
+        if score >= threshold and not candidate.deleted:
+            matches.append((score, candidate))
+    matches.sort(key=lambda match: (-match[0], match[1].user_id))
+    return matches[:limit] if limit else matches
+
+
+def precompile_templates():
+    """Load every template once so the first requests don't pay for compiling."""
+    for name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(name)
+
+
+precompile_templates()
+
+
+@app.before_request
+def require_schema():
+    """Prepare the schema on this process's first request; refuse to serve without it."""
+    try:
+        ensure_schema()
+    except SchemaNotReady as error:
+        response = jsonify({"success": False, "error": str(error)})
+        response.status_code = 503
+        return response
+
+
+class MemoryIdempotencyStore:
+    """Bounded, TTL-expiring idempotency store local to this process."""
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def claim(self, key, fingerprint):
+        """Return ("new", None), or the existing entry's state and response."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["expires_at"] < now:
+                self.entries[key] = {"fingerprint": fingerprint, "response": None,
+                                     "expires_at": now + IDEMPOTENCY_PENDING_TIMEOUT}
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+                return "new", None
+        if entry["fingerprint"] != fingerprint:
+            return "mismatch", None
+        if entry["response"] is None:
+            return "pending", None
+        return "replay", entry["response"]
+
+    def save(self, key, fingerprint, response):
+        with self.lock:
+            self.entries[key] = {"fingerprint": fingerprint, "response": response,
+                                 "expires_at": time.time() + self.ttl}
+
+    def release(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class SQLiteIdempotencyStore:
+    """Idempotency store on the IdempotencyKey table, for multi-worker setups."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.table = IdempotencyRecord.__table__
+
+    def claim(self, key, fingerprint):
+        """Return ("new", None), or the existing entry's state and response."""
+        now = time.time()
+        with db.engine.begin() as connection:
+            connection.execute(delete(self.table).where(
+                self.table.c.key == key, self.table.c.expires_at < now))
+            claimed = connection.execute(
+                sqlite_insert(self.table)
+                .values(key=key, fingerprint=fingerprint,
+                        expires_at=now + IDEMPOTENCY_PENDING_TIMEOUT)
+                .on_conflict_do_nothing()).rowcount
+            if claimed:
+                return "new", None
+            row = connection.execute(
+                select(self.table).where(self.table.c.key == key)).first()
+        if row.fingerprint != fingerprint:
+            return "mismatch", None
+        if row.status_code is None:
+            return "pending", None
+        return "replay", (row.status_code, row.mimetype, row.body)
+
+    def save(self, key, fingerprint, response):
+        status_code, mimetype, body = response
+        now = time.time()
+        with db.engine.begin() as connection:
+            connection.execute(
+                self.table.update().where(self.table.c.key == key)
+                .values(fingerprint=fingerprint, status_code=status_code,
+                        mimetype=mimetype, body=body, expires_at=now + self.ttl))
+            connection.execute(delete(self.table).where(self.table.c.expires_at < now))
+
+    def release(self, key):
+        with db.engine.begin() as connection:
+            connection.execute(delete(self.table).where(self.table.c.key == key))
+
+
+def make_idempotency_store(backend):
+    """The idempotency store for an IDEMPOTENCY_BACKEND value."""
+    if backend == "sqlite":
+        return SQLiteIdempotencyStore(app.config["IDEMPOTENCY_TTL"])
+    return MemoryIdempotencyStore(
+        app.config["IDEMPOTENCY_TTL"], app.config["IDEMPOTENCY_MAX_KEYS"])
+
+
+idempotency_store = make_idempotency_store(app.config["IDEMPOTENCY_BACKEND"])
+
+
+def parse_export_columns(value):
+    """Split a comma separated column list, defaulting to every export column."""
+    if not value:
+        return list(EXPORT_COLUMNS)
+    columns = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = [name for name in columns if name not in EXPORT_COLUMNS]
+    if unknown or not columns:
+        raise ValueError(f"Unknown export columns: {', '.join(unknown)}")
+    return columns
+
+
+def iter_user_batches(columns, batch_size=EXPORT_BATCH_SIZE, include_deleted=False):
+    """Yield row batches in user_id order using keyset pages, never the whole table."""
+    table = User.__table__
+    selected = [table.c[name] for name in columns]
+    last_id = 0
+    while True:
+        query = select(table.c.user_id, *selected).where(table.c.user_id > last_id)
+        if not include_deleted:
+            query = query.where(table.c.deleted == db.false())
+        rows = db.session.execute(
+            query.order_by(table.c.user_id).limit(batch_size)).all()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield [row[1:] for row in rows]
+
+
+def export_csv(columns, **kwargs):
+    """Yield the export as encoded CSV chunks, one per batch."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for batch in iter_user_batches(columns, **kwargs):
+        writer.writerows(batch)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+class ChunkSink:
+    """Write-only file object handing out whatever was written since the last drain."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def parquet_schema(columns):
+    """Map User columns onto an Arrow schema."""
+    types = {
+        db.Integer: pa.int64(),
+        db.String: pa.string(),
+        db.Boolean: pa.bool_(),
+        db.DateTime: pa.timestamp("us"),
+    }
+    fields = []
+    for name in columns:
+        column_type = User.__table__.c[name].type
+        arrow_type = next(t for k, t in types.items() if isinstance(column_type, k))
+        fields.append(pa.field(name, arrow_type))
+    return pa.schema(fields)
+
+
+def export_parquet(columns, sink=None, **kwargs):
+    """
+    Yield the export as Parquet bytes, one row group at a time.
+    Rows are buffered column-wise only up to PARQUET_ROW_GROUP_SIZE.
+    With a path as sink the file is written directly and nothing is yielded.
+    """
+    schema = parquet_schema(columns)
+    stream = ChunkSink() if sink is None else sink
+    pending = [[] for _ in columns]
+    with pq.ParquetWriter(stream, schema) as writer:
+        for batch in iter_user_batches(columns, **kwargs):
+            for row in batch:
+                for values, value in zip(pending, row):
+                    values.append(value)
+            if len(pending[0]) >= PARQUET_ROW_GROUP_SIZE:
+                writer.write_table(pa.Table.from_arrays(pending, schema=schema))
+                pending = [[] for _ in columns]
+                if sink is None:
+                    yield stream.drain()
+        if pending[0]:
+            writer.write_table(pa.Table.from_arrays(pending, schema=schema))
+    if sink is None:
+        yield stream.drain()
+
+
+@users_cli.command("export")
+@click.option("--format", "fmt", type=click.Choice(["csv", "parquet"]),
+              default="csv", show_default=True)
+@click.option("--columns", default="", help="Comma separated column subset.")
+@click.option("--include-deleted", is_flag=True, help="Export soft-deleted users too.")
+@click.option("--batch-size", default=EXPORT_BATCH_SIZE, show_default=True)
+@click.argument("output", type=click.Path(dir_okay=False, writable=True))
+@requires_schema
+def export_users_command(fmt, columns, include_deleted, batch_size, output):
+    """Stream the User table to a CSV or Parquet file."""
+    try:
+        columns = parse_export_columns(columns)
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint="--columns")
+    options = {"batch_size": batch_size, "include_deleted": include_deleted}
+    if fmt == "parquet":
+        if pq is None:
+            raise click.ClickException("Parquet export requires pyarrow.")
+        for _ in export_parquet(columns, sink=output, **options):
+            pass
+    else:
+        with open(output, "wb") as handle:
+            for chunk in export_csv(columns, **options):
+                handle.write(chunk)
+    click.echo(f"Exported users to {output}.")
+
+
+def parse_bool(value):
+    """Read booleans from CSV text or JSON values."""
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "t", "yes", "y")
+
+
+def read_import_rows(handle, fmt):
+    """Yield dict rows from a CSV or NDJSON stream, one line at a time."""
+    if fmt == "csv":
+        yield from csv.DictReader(handle)
+        return
+    for line in handle:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+def validate_import_row(row):
+    """Return a row tuple ready for insertion, or None when it can't be imported."""
+    try:
+        values = [str(row[name]).strip() for name in IMPORT_FIELDS]
+        newsletter = parse_bool(row.get("newsletter") or False)
+        subscription_id = int(row.get("subscription_id") or 1)
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return None
+    if not all(values) or any(len(value) > 255 for value in values):
+        return None
+    return (*values, int(newsletter), subscription_id)
+
+
+def fetch_user_ids_by_email(connection, emails):
+    """Map emails to user ids, chunked to respect the SQLite parameter limit."""
+    found = {}
+    for start in range(0, len(emails), SQLITE_MAX_PARAMS):
+        chunk = emails[start:start + SQLITE_MAX_PARAMS]
+        marks = ", ".join("?" * len(chunk))
+        found.update(connection.exec_driver_sql(
+            f'SELECT email, user_id FROM "User" WHERE email IN ({marks})',
+            tuple(chunk)).all())
+    return found
+
+
+def record_bulk_changes(connection, changes, now):
+    """
+    Change feed counterpart of record_user_change() for Core bulk writes.
+    Must run after the batch wrote, while this transaction holds the write lock.
+    """
+    if not changes:
+        return
+    start = connection.exec_driver_sql(
+        "SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence "
+        "WHERE name = 'UserChange'), 0), "
+        'COALESCE((SELECT MAX(seq) FROM "UserChange"), 0))').scalar()
+    stamp = sqlite_timestamp(now)
+    entries = [(start + offset, user_id, op, stamp)
+               for offset, (user_id, op) in enumerate(changes, 1)]
+    connection.exec_driver_sql(
+        'INSERT INTO "UserChange" (seq, user_id, op, changed_at) VALUES (?, ?, ?, ?)',
+        entries)
+    connection.exec_driver_sql(
+        'UPDATE "User" SET change_seq = ?, updated_at = ? WHERE user_id = ?',
+        [(seq, stamp, user_id) for seq, user_id, _, _ in entries])
+    for user_id, _ in changes:
+        user_fragments.invalidate(user_id)
+    # Hashing similarity bands here would cap the import rate; updated users
+    # only lose their stale bands and index_unbanded_users() catches up after.
+    user_ids = [user_id for user_id, op in changes if op == "update"]
+    for start in range(0, len(user_ids), SQLITE_MAX_PARAMS):
+        chunk = user_ids[start:start + SQLITE_MAX_PARAMS]
+        connection.exec_driver_sql(
+            'DELETE FROM "UserSimilarityBand" WHERE user_id IN '
+            f'({", ".join("?" * len(chunk))})', tuple(chunk))
+
 
-db = SQLAlchemy(app)
+def index_unbanded_users(connection, batch_size=MIGRATION_BATCH_SIZE):
+    """
+    Give live users without similarity bands, such as bulk imports, their
+    bands, one committed keyset batch at a time. Returns the number indexed.
+    """
+    indexed = last_id = 0
+    while True:
+        rows = connection.exec_driver_sql(
+            'SELECT user_id, first_name, last_name, email, deleted FROM "User" '
+            "WHERE user_id > ? AND deleted = 0 AND NOT EXISTS (SELECT 1 FROM "
+            '"UserSimilarityBand" WHERE "UserSimilarityBand".user_id = "User".user_id) '
+            "ORDER BY user_id LIMIT ?", (last_id, batch_size)).all()
+        if not rows:
+            return indexed
+        index_user_similarity(connection, rows, replace=False)
+        connection.commit()
+        indexed += len(rows)
+        last_id = rows[-1][0]
 
-def is_json(expression):
-    """Determine if a string is in JSON format."""
-    return str(type(expression)) == "<class 'dict'>"
 
+def import_user_batch(connection, rows, on_conflict):
+    """Write one validated batch, returning (inserted, updated, skipped)."""
+    now = datetime.now()
+    stamp = sqlite_timestamp(now)
+    # Collapse duplicates inside the batch: first wins on skip, last on upsert.
+    by_email = {}
+    for row in rows:
+        if on_conflict == "upsert" or row[2] not in by_email:
+            by_email[row[2]] = row
+    skipped = len(rows) - len(by_email)
+    existing = fetch_user_ids_by_email(connection, list(by_email))
+    new_rows = [row for email, row in by_email.items() if email not in existing]
+    changes = []
+    if new_rows:
+        connection.exec_driver_sql(
+            'INSERT INTO "User" (first_name, last_name, email, password, newsletter, '
+            "subscription_id, created, updated_at, deleted, change_seq) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, 0) ON CONFLICT(email) DO NOTHING",
+            [(*row, stamp, stamp) for row in new_rows])
+        inserted = fetch_user_ids_by_email(connection, [row[2] for row in new_rows])
+        for email in inserted:
+            email_filter.add(email)
+        changes.extend((user_id, "insert") for user_id in sorted(inserted.values()))
+    if on_conflict == "upsert" and existing:
+        connection.exec_driver_sql(
+            'UPDATE "User" SET first_name = ?, last_name = ?, password = ?, '
+            "newsletter = ?, subscription_id = ? WHERE user_id = ?",
+            [(row[0], row[1], row[3], row[4], row[5], existing[email])
+             for email, row in by_email.items() if email in existing])
+        changes.extend((existing[email], "update") for email in by_email
+                       if email in existing)
+    else:
+        skipped += len(existing)
+    record_bulk_changes(connection, changes, now)
+    inserted_count = sum(1 for _, op in changes if op == "insert")
+    return inserted_count, len(changes) - inserted_count, skipped
 
-def dump_datetime(value):
-    """Deserialize datetime object into string form for JSON processing."""
-    if value is None:
-        return None
-    return [value.strftime("%Y-%m-%d"), value.strftime("%H:%M:%S")]
 
+@users_cli.command("import")
+@click.argument("source", type=click.File("r", encoding="utf-8"))
+@click.option("--format", "fmt", type=click.Choice(["auto", "csv", "ndjson"]),
+              default="auto", show_default=True)
+@click.option("--on-conflict", type=click.Choice(["skip", "upsert"]),
+              default="skip", show_default=True,
+              help="What to do with emails that are already registered.")
+@click.option("--batch-size", default=IMPORT_BATCH_SIZE, show_default=True)
+@click.option("--commit-every", default=IMPORT_COMMIT_EVERY, show_default=True)
+@click.option("--defer-indexes", is_flag=True,
+              help="Drop secondary User indexes during the import and rebuild them after.")
+@click.option("--unsafe-fast", is_flag=True,
+              help="Run with synchronous=OFF: an OS crash or power loss mid-import "
+                   "can corrupt the database.")
+@click.option("--defer-similarity", is_flag=True,
+              help="Leave similarity indexing to `flask users index-similarity`.")
+@requires_schema
+def import_users_command(source, fmt, on_conflict, batch_size, commit_every,
+                         defer_indexes, unsafe_fast, defer_similarity):
+    """Bulk load users from a CSV or NDJSON file ('-' reads stdin)."""
+    if fmt == "auto":
+        fmt = "ndjson" if source.name.endswith((".ndjson", ".jsonl")) else "csv"
+    totals = {"read": 0, "invalid": 0, "inserted": 0, "updated": 0, "skipped": 0}
+    started = time.perf_counter()
 
-class User(db.Model):
-    """Data model for user accounts."""
-    __tablename__ = "User"
-    user_id = db.Column("user_id", db.Integer, primary_key=True)
-    first_name = db.Column(db.String(255), nullable=False)
-    last_name = db.Column(db.String(255), nullable=False)
-    email = db.Column(db.String(255), unique=True, nullable=False)
-    password = db.Column(db.String(255), nullable=False)
-    newsletter = db.Column(db.Boolean, default=False, nullable=False)
-    subscription_id = db.Column(db.Integer, default=1, nullable=False)
-    created = db.Column(
-        db.DateTime(timezone=True), default=datetime.now(), nullable=False
-    )
-    deleted = db.Column(db.Boolean, default=False, nullable=False)
+    def report():
+        elapsed = time.perf_counter() - started
+        rate = totals["read"] / elapsed if elapsed else 0
+        click.echo(", ".join(f"{key} {value:,}" for key, value in totals.items())
+                   + f" ({rate:,.0f} rows/sec)", err=True)
+
+    with db.engine.connect() as connection:
+        # The database is in WAL mode, where NORMAL only syncs at checkpoints
+        # and a crash can lose the last commits but never corrupts the file.
+        connection.exec_driver_sql(
+            "PRAGMA synchronous = OFF" if unsafe_fast else "PRAGMA synchronous = NORMAL")
+        connection.exec_driver_sql("PRAGMA cache_size = -262144")
+        connection.exec_driver_sql("PRAGMA temp_store = MEMORY")
+        deferred = []
+        if defer_indexes:
+            # The UNIQUE(email) autoindex has no SQL and stays: conflicts need it.
+            deferred = connection.exec_driver_sql(
+                "SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+                "AND tbl_name = 'User' AND sql IS NOT NULL").all()
+            for name, _ in deferred:
+                connection.exec_driver_sql(f'DROP INDEX "{name}"')
+            connection.commit()
+        try:
+            batch, uncommitted = [], 0
+            rows = read_import_rows(source, fmt)
+            while True:
+                for raw in rows:
+                    totals["read"] += 1
+                    row = validate_import_row(raw) if isinstance(raw, dict) else None
+                    if row is None:
+                        totals["invalid"] += 1
+                        continue
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        break
+                if not batch:
+                    break
+                inserted, updated, skipped = import_user_batch(
+                    connection, batch, on_conflict)
+                totals["inserted"] += inserted
+                totals["updated"] += updated
+                totals["skipped"] += skipped
+                uncommitted += len(batch)
+                batch = []
+                if uncommitted >= commit_every:
+                    connection.commit()
+                    uncommitted = 0
+                    report()
+            connection.commit()
+        finally:
+            if deferred:
+                click.echo(f"Rebuilding {len(deferred)} deferred indexes.", err=True)
+                for _, sql in deferred:
+                    connection.exec_driver_sql(sql)
+                connection.commit()
+        report()
+        if defer_similarity:
+            click.echo("Run `flask users index-similarity` to index imported users "
+                       "for duplicate detection.", err=True)
+            return
+        started = time.perf_counter()
+        indexed = index_unbanded_users(connection)
+        click.echo(f"Indexed {indexed:,} users for duplicate detection in "
+                   f"{time.perf_counter() - started:.1f}s.", err=True)
+
+
+@users_cli.command("index-similarity")
+@requires_schema
+def index_similarity_command():
+    """Index live users that have no similarity bands yet."""
+    with db.engine.connect() as connection:
+        indexed = index_unbanded_users(connection)
+    click.echo(f"Indexed {indexed:,} users for duplicate detection.")
+
+
+def iter_newsletter_recipients(after=0, chunk_size=NEWSLETTER_CHUNK_SIZE):
+    """
+    Yield chunks of opted-in, live recipients in user_id order.
+    Each chunk is one keyset seek on ix_User_newsletter; resume from the
+    last user_id of the previous chunk to continue an interrupted send.
+    """
+    table = User.__table__
+    while True:
+        rows = db.session.execute(
+            select(table.c.user_id, table.c.email, table.c.first_name)
+            .where(table.c.newsletter == db.true(),
+                   table.c.deleted == db.false(),
+                   table.c.user_id > after)
+            .order_by(table.c.user_id)
+            .limit(chunk_size)).all()
+        if not rows:
+            return
+        after = rows[-1].user_id
+        yield [row._asdict() for row in rows]
+        if len(rows) < chunk_size:
+            return
+
+
+@newsletter_cli.command("recipients")
+@click.option("--output", type=click.File("w", encoding="utf-8"), default="-",
+              help="NDJSON destination, stdout by default.")
+@click.option("--checkpoint", "checkpoint_path", type=click.Path(dir_okay=False),
+              help="File holding the last exported user_id; resumes from it.")
+@click.option("--chunk-size", default=NEWSLETTER_CHUNK_SIZE, show_default=True)
+@requires_schema
+def newsletter_recipients_command(output, checkpoint_path, chunk_size):
+    """Write opted-in recipients as NDJSON, checkpointing after every chunk."""
+    after = 0
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, encoding="utf-8") as handle:
+            after = int(handle.read().strip() or 0)
+    total = 0
+    for chunk in iter_newsletter_recipients(after, chunk_size):
+        output.writelines(json.dumps(recipient) + "\n" for recipient in chunk)
+        output.flush()
+        total += len(chunk)
+        if checkpoint_path:
+            temporary = checkpoint_path + ".tmp"
+            with open(temporary, "w", encoding="utf-8") as handle:
+                handle.write(str(chunk[-1]["user_id"]))
+            os.replace(temporary, checkpoint_path)
+    click.echo(f"Wrote {total:,} recipients.", err=True)
 
-    def __repr__(self):
-        return f"{self.first_name}, {self.last_name} > ({self.email})"
+
+def idempotent(view):
+    """
+    Honour the Idempotency-Key header: the first request with a key runs the
+    view and stores its response; retries with the same key and body get
+    the stored response back without running the view again.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({"success": False, "error": "Idempotency-Key is too long."})
+        scoped_key = f"{request.method} {request.path} {key}"
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        state, stored = idempotency_store.claim(scoped_key, fingerprint)
+        if state == "replay":
+            status_code, mimetype, body = stored
+            # The outcome is replayed in whichever encoding this retry asks for.
+            body, mimetype = reencode_body(body, mimetype, negotiated_mimetype())
+            response = Response(body, status=status_code, mimetype=mimetype)
+            response.headers["Idempotent-Replayed"] = "true"
+            response.vary.add("Accept")
+            return response
+        if state == "mismatch":
+            res = {"success": False,
+                   "error": "Idempotency-Key was already used with a different payload."}
+            return jsonify(res)
+        if state == "pending":
+            res = {"success": False,
+                   "error": "A request with this Idempotency-Key is still in progress."}
+            return jsonify(res)
+        try:
+            response = make_response(view(*args, **kwargs))
+        except BaseException:
+            # The view may hold SQLite's write lock, which release() would wait on.
+            db.session.rollback()
+            idempotency_store.release(scoped_key)
+            raise
+        idempotency_store.save(scoped_key, fingerprint, (
+            response.status_code, response.mimetype, response.get_data()))
+        return response
+    return wrapper
+
+
+def build_users_query(args):
+    """
+    Listing query for /users/ from its created_after, created_before and
+    sort parameters; a leading "-" on sort reverses the order.
+    """
+    query = User.query.filter_by(deleted=False)
+    if value := args.get("created_after"):
+        query = query.filter(User.created > datetime.fromisoformat(value))
+    if value := args.get("created_before"):
+        query = query.filter(User.created < datetime.fromisoformat(value))
+    if sort := args.get("sort"):
+        descending = sort.startswith("-")
+        if sort.lstrip("-") not in USER_SORTS:
+            raise ValueError(f"Unknown sort key: {sort}")
+        names, _ = USER_SORTS[sort.lstrip("-")]
+        order = [getattr(User, name) for name in names] + [User.user_id]
+        query = query.order_by(*(column.desc() if descending else column
+                                 for column in order))
+    return query
+
+
+@users_cli.command("explain")
+@requires_schema
+def explain_users_queries():
+    """Check that filtered and sorted /users/ queries use their indexes."""
+    cases = [({"created_after": "2024-01-01", "created_before": "2025-01-01"},
+              "ix_User_deleted_created")]
+    for key, (_, index) in USER_SORTS.items():
+        cases.append(({"sort": key}, index))
+        cases.append(({"sort": "-" + key}, index))
+    failures = 0
+    for args, index in cases:
+        compiled = build_users_query(args).statement.compile(dialect=db.engine.dialect)
+        params = tuple(str(value) if isinstance(value, datetime) else value
+                       for value in (compiled.params[name]
+                                     for name in compiled.positiontup))
+        plan = [row[-1] for row in db.session.connection().exec_driver_sql(
+            "EXPLAIN QUERY PLAN " + str(compiled), params)]
+        used = any(index in line for line in plan)
+        sorted_in_temp = any("TEMP B-TREE" in line for line in plan)
+        ok = used and not sorted_in_temp
+        failures += not ok
+        click.echo(f"{'ok' if ok else 'FAIL'}  {args}  -> {'; '.join(plan)}")
+    if failures:
+        raise click.ClickException(f"{failures} queries don't use their index.")
+
+
+class AdmissionLane:
+    """
+    Concurrency limit with a CoDel-style queue.
+    Requests wait for a slot up to max_wait; once max_waiting are queued,
+    newcomers are shed at once, as every waiter holds a server thread.
+    Once queueing delay has stayed above target for a whole interval the
+    lane starts shedding: requests that cannot start right away fail fast,
+    until one is admitted without waiting. Separate lanes keep slow scans
+    from starving cheap lookups.
+    """
+
+    def __init__(self, name, limit, target, interval, max_wait, max_waiting):
+        self.name = name
+        self.limit = limit
+        self.target = target
+        self.interval = interval
+        self.max_wait = max_wait
+        self.max_waiting = max_waiting
+        self.active = 0
+        self.waiting = 0
+        self.above_since = None
+        self.dropping = False
+        self.stats = {"admitted": 0, "shed": 0}
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Take a slot, returning False when the request should be shed."""
+        started = time.monotonic()
+        with self.condition:
+            if self.active < self.limit and not self.waiting:
+                return self.admit(started)
+            if self.dropping or self.waiting >= self.max_waiting:
+                return self.shed()
+            self.waiting += 1
+            try:
+                deadline = started + self.max_wait
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or self.dropping:
+                        return self.shed()
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            return self.admit(started)
+
+    def admit(self, started):
+        now = time.monotonic()
+        if now - started < self.target:
+            self.above_since = None
+            self.dropping = False
+        elif self.above_since is None:
+            self.above_since = now
+        elif now - self.above_since >= self.interval and not self.dropping:
+            self.dropping = True
+            self.condition.notify_all()
+        self.active += 1
+        self.stats["admitted"] += 1
+        return True
+
+    def shed(self):
+        self.stats["shed"] += 1
+        return False
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
 
     @property
     def serialize(self):
-        """Return object data in easily serializable format"""
-        return {
-            "user_id": self.user_id,
-            "first_name": self.first_name,
-            "last_name": self.last_name,
-            "email": self.email,
-            "created": dump_datetime(self.created),
-            "deleted": self.deleted
-            # This is an example how to deal with Many2Many relations
-            # 'many2many'  : self.serialize_many2many
-        }
+        """Return lane state in easily serializable format"""
+        return {"lane": self.name, "limit": self.limit, "active": self.active,
+                "waiting": self.waiting, "max_waiting": self.max_waiting,
+                "dropping": self.dropping, **self.stats}
+
+
+admission_lanes = {name: AdmissionLane(name, *settings)
+                   for name, settings in ADMISSION_LANES.items()}
+
+
+class ThreadReserve:
+    """
+    Caps the server threads that requests outside the cheap lane may hold,
+    running or queued, so a cheap lookup always finds a free thread.
+    limit stays None, meaning uncapped, unless the thread count is known;
+    `flask serve` sets it from --threads.
+    """
+
+    def __init__(self):
+        self.limit = None
+        self.held = 0
+        self.shed = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            if self.limit is not None and self.held >= self.limit:
+                self.shed += 1
+                return False
+            self.held += 1
+            return True
+
+    def give(self):
+        with self.lock:
+            self.held -= 1
 
     @property
-    def serialize_many2many(self):
+    def serialize(self):
+        """Return reserve state in easily serializable format"""
+        return {"limit": self.limit, "held": self.held, "shed": self.shed}
+
+
+thread_reserve = ThreadReserve()
+
+
+def busy_response():
+    """503 telling the client to back off and retry."""
+    res = {"success": False, "error": "Server is busy, retry later."}
+    response = jsonify(res)
+    response.status_code = 503
+    response.headers["Retry-After"] = str(ADMISSION_RETRY_AFTER)
+    return response
+
+
+class RequestCapture:
+    """
+    Appends sampled requests to an NDJSON file, one line per request, with
+    a single O_APPEND write so every worker process can share the file.
+    Passwords in JSON bodies are replaced so captures are safe to pass around.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, separators=(",", ":")).encode() + b"\n"
+        if self.fd is None:
+            with self.lock:
+                if self.fd is None:
+                    self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                      0o600)
+        os.write(self.fd, line)
+
+    @staticmethod
+    def redact(value):
+        if isinstance(value, dict):
+            return {key: "redacted" if key == "password" else RequestCapture.redact(item)
+                    for key, item in value.items()}
+        if isinstance(value, list):
+            return [RequestCapture.redact(item) for item in value]
+        return value
+
+    def body(self):
         """
-        Return object's relations in easily serializable format.
-        NB! Calls many2many's serialize property.
+        The request body as text, or None when it is empty or too large.
+        Any body that parses as JSON is redacted, whatever its Content-Type,
+        since the write endpoints decode untyped bodies too; one that doesn't
+        parse is dropped for endpoints that may carry passwords.
         """
-        return [item.serialize for item in self.many2many]
+        data = request.get_data()
+        if not data or len(data) > CAPTURE_MAX_BODY:
+            return None
+        try:
+            return json.dumps(self.redact(json.loads(data)))
+        except ValueError:
+            if request.endpoint in CAPTURE_PRIVATE_ENDPOINTS:
+                return None
+        return data.decode("utf-8", "replace")
+
+
+request_capture = RequestCapture(app.config["REQUEST_CAPTURE_PATH"])
+
+
+@app.before_request
+def start_request_capture():
+    """Pick the requests to capture; registered first so timing covers admission."""
+    rate = app.config["REQUEST_CAPTURE_RATE"]
+    if rate and random.random() < rate and "X-Profile-Token" not in request.headers:
+        g.capture_started = (time.time(), time.perf_counter())
+
+
+@app.after_request
+def finish_request_capture(response):
+    """Append the sampled request, with its status and service time."""
+    started = g.pop("capture_started", None)
+    if started is None:
+        return response
+    record = {
+        "t": round(started[0], 6),
+        "method": request.method,
+        "path": request.full_path if request.query_string else request.path,
+        "endpoint": request.endpoint,
+        "headers": {name: request.headers[name] for name in CAPTURE_HEADERS
+                    if name in request.headers},
+        "body": request_capture.body(),
+        "status": response.status_code,
+        "ms": round((time.perf_counter() - started[1]) * 1000, 3),
+    }
+    try:
+        request_capture.write(record)
+    except OSError:
+        app.logger.exception("Could not write request capture")
+    return response
+
+
+@app.before_request
+def admit_request():
+    """Queue the request in its lane, or answer 503 when the lane is shedding."""
+    if not app.config["ADMISSION_CONTROL"]:
+        return None
+    lane_name = ADMISSION_ROUTES.get(request.endpoint, "cheap")
+    if lane_name is None:
+        return None
+    lane = admission_lanes[lane_name]
+    reserved = lane_name != "cheap"
+    if reserved and not thread_reserve.take():
+        return busy_response()
+    if not lane.acquire():
+        if reserved:
+            thread_reserve.give()
+        return busy_response()
+    g.admission_lane = lane
+    g.admission_reserved = reserved
+    return None
+
+
+@app.teardown_request
+def release_admission(exc):
+    """Free the request's lane slot once it, or its stream, has finished."""
+    lane = g.pop("admission_lane", None)
+    if lane is not None:
+        lane.release()
+    if g.pop("admission_reserved", False):
+        thread_reserve.give()
+
+
+class StackSampler:
+    """
+    Sampling CPU profiler: a background thread reads the Python stacks of
+    the target thread (or every other thread) at a fixed interval and counts
+    them in the collapsed-stack format that flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.counts = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if self.thread_id is not None and thread_id != self.thread_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                                 f":{code.co_firstlineno})")
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+
+    def collapsed(self):
+        """Return the samples as collapsed stacks, one "stack count" per line."""
+        return "".join(f"{stack} {count}\n" for stack, count
+                       in sorted(self.counts.items(), key=lambda item: -item[1]))
+
+
+def profiling_authorized():
+    """True when profiling is enabled and the request carries its token."""
+    token = app.config["PROFILING_TOKEN"]
+    supplied = request.headers.get("X-Profile-Token", "")
+    return bool(token) and hmac.compare_digest(supplied.encode(), token.encode())
+
+
+@app.before_request
+def start_request_profile():
+    """Profile this request when it asks for it with a valid token."""
+    if request.headers.get("X-Profile-Token") and profiling_authorized() \
+            and not request.path.startswith("/admin/profile/"):
+        g.profiler = StackSampler(PROFILE_REQUEST_SAMPLE_INTERVAL,
+                                  threading.get_ident()).start()
+
+
+@app.after_request
+def finish_request_profile(response):
+    """
+    Replace a profiled request's response with its collapsed stacks.
+    Streamed responses do their work after this hook runs, so they are
+    refused rather than answered with an empty profile.
+    """
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return response
+    profiler.stop()
+    if response.is_streamed:
+        response.close()
+        return jsonify({"success": False,
+                        "error": "Streamed responses can't be profiled."})
+    profile = Response(profiler.collapsed(), mimetype="text/plain")
+    profile.headers["X-Profile-Samples"] = str(profiler.samples)
+    profile.headers["X-Profiled-Status"] = str(response.status_code)
+    return profile
+
+
+@app.teardown_request
+def stop_request_profile(exc):
+    """Make sure a failed request doesn't leave its sampler running."""
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+
+
+def wants_html():
+    """
+    True when the client prefers HTML, as browsers do, over JSON. Either
+    way the response now depends on Accept, so caches are told to key on it.
+    """
+    @after_this_request
+    def vary_on_accept(response):
+        response.vary.add("Accept")
+        return response
+
+    best = request.accept_mimetypes.best_match(["application/json", "text/html"])
+    return best == "text/html"
+
+
+def render_user_card(user_data):
+    """Render one user card, reusing the cached fragment when it is current."""
+    card = user_fragments.get(user_data["user_id"], user_data["change_seq"])
+    if card is None:
+        card = Markup(render_template("_user_card.html", user=user_data))
+        user_fragments.set(user_data["user_id"], user_data["change_seq"], card)
+    return card
+
+
+def iter_user_cards():
+    """Yield rendered cards for live users, reading the table in batches."""
+    for batch in iter_user_batches(CARD_COLUMNS):
+        for row in batch:
+            yield render_user_card(dict(zip(CARD_COLUMNS, row)))
 
 
 @app.route("/")
@@ -94,18 +2422,222 @@ def return_json_post():
     return jsonify(data)
 
 
+@app.route("/stats/email-filter/")
+def email_filter_stats():
+    """Email Bloom filter settings and hit/miss counters."""
+    return jsonify(email_filter.serialize)
+
+
+@app.route("/admin/profile/cpu/")
+def profile_cpu():
+    """Sample every thread for ?seconds= and return collapsed stacks."""
+    if not profiling_authorized():
+        abort(404)
+    try:
+        seconds = min(max(float(request.args.get("seconds", 10)), 0.1),
+                      PROFILE_MAX_SECONDS)
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid seconds value."})
+    profiler = StackSampler().start()
+    time.sleep(seconds)
+    profiler.stop()
+    response = Response(profiler.collapsed(), mimetype="text/plain")
+    response.headers["X-Profile-Samples"] = str(profiler.samples)
+    return response
+
+
+memory_snapshots = {"previous": None}
+
+
+@app.route("/admin/profile/memory/")
+def profile_memory():
+    """
+    Tracemalloc snapshots. The first call starts tracing; each later call
+    returns the largest allocation sites and their growth since the last
+    call. ?stop=1 stops tracing and frees the snapshots.
+    """
+    if not profiling_authorized():
+        abort(404)
+    try:
+        frames = min(max(int(request.args.get("frames", 1)), 1), PROFILE_MAX_FRAMES)
+        limit = min(max(int(request.args.get("limit", 25)), 1), PROFILE_MAX_TOP)
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid frames or limit value."})
+    if request.args.get("stop"):
+        tracemalloc.stop()
+        memory_snapshots["previous"] = None
+        return jsonify({"success": True, "tracing": False})
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+        memory_snapshots["previous"] = tracemalloc.take_snapshot()
+        return jsonify({"success": True, "tracing": True})
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)])
+    previous, memory_snapshots["previous"] = memory_snapshots["previous"], snapshot
+    current, peak = tracemalloc.get_traced_memory()
+    res = {
+        "success": True,
+        "tracing": True,
+        "current_bytes": current,
+        "peak_bytes": peak,
+        "top": [{"location": str(stat.traceback), "size": stat.size,
+                 "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:limit]],
+        "growth": [{"location": str(stat.traceback), "size_diff": stat.size_diff,
+                    "count_diff": stat.count_diff}
+                   for stat in snapshot.compare_to(previous, "lineno")[:limit]],
+    }
+    return jsonify(res)
+
+
+@app.route("/stats/admission/")
+def admission_stats():
+    """Admission lanes' limits, occupancy and shed counts."""
+    return jsonify(lanes=[lane.serialize for lane in admission_lanes.values()],
+                   thread_reserve=thread_reserve.serialize)
+
+
+@app.route("/subscriptions/")
+def subscriptions():
+    """Listing subscription plans."""
+    return jsonify(subscriptions=list(subscription_plans.all().values()))
+
+
 @app.route("/users/")
 def users():
     """Listing users."""
-    all_users = User.query.filter_by(deleted=False)
+    if wants_html():
+        return stream_template("users.html", cards=iter_user_cards())
+    try:
+        all_users = build_users_query(request.args)
+    except ValueError as error:
+        res = {"success": False, "error": "Invalid filter or sort value.",
+               "detail": str(error)}
+        return jsonify(res)
     return jsonify(users=[i.serialize for i in all_users.all()])
 
 
+@app.route("/users/changes/")
+def user_changes():
+    """Incremental change feed, resumable from the returned next_since token."""
+    try:
+        since = int(request.args.get("since", 0))
+        limit = min(max(int(request.args.get("limit", 500)), 1), 5000)
+    except (TypeError, ValueError):
+        res = {"success": False, "error": "Invalid since or limit value."}
+        return jsonify(res)
+    changes = (UserChange.query.filter(UserChange.seq > since)
+               .order_by(UserChange.seq).limit(limit + 1).all())
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    user_ids = {change.user_id for change in changes if change.op != "delete"}
+    current = {}
+    if user_ids:
+        current = {u.user_id: u.serialize
+                   for u in users_by_ids(list(user_ids))}
+    feed = []
+    for change in changes:
+        item = change.serialize
+        if change.op != "delete":
+            item["user"] = current.get(change.user_id)
+        feed.append(item)
+    res = {
+        "changes": feed,
+        "next_since": changes[-1].seq if changes else since,
+        "has_more": has_more,
+    }
+    return jsonify(res)
+
+
+@app.route("/users/export/")
+def export_users():
+    """Streaming bulk export as CSV or Parquet."""
+    fmt = request.args.get("format", "csv")
+    include_deleted = request.args.get("include_deleted", "") in ("1", "true")
+    try:
+        columns = parse_export_columns(request.args.get("columns"))
+    except ValueError as error:
+        return jsonify({"success": False, "error": str(error)})
+    if fmt == "csv":
+        body = export_csv(columns, include_deleted=include_deleted)
+        mimetype = "text/csv"
+    elif fmt == "parquet":
+        if pq is None:
+            res = {"success": False, "error": "Parquet export requires pyarrow."}
+            return jsonify(res)
+        body = export_parquet(columns, include_deleted=include_deleted)
+        mimetype = "application/vnd.apache.parquet"
+    else:
+        return jsonify({"success": False, "error": "Unsupported export format."})
+    headers = {"Content-Disposition": f"attachment; filename=users.{fmt}"}
+    return Response(stream_with_context(body), mimetype=mimetype, headers=headers)
+
+
+@app.route("/newsletter/recipients/")
+def newsletter_recipients():
+    """One chunk of newsletter recipients, resumable from the checkpoint."""
+    try:
+        after = int(request.args.get("after", 0))
+        limit = min(max(int(request.args.get("limit", NEWSLETTER_CHUNK_SIZE)), 1),
+                    NEWSLETTER_MAX_CHUNK_SIZE)
+    except (TypeError, ValueError):
+        res = {"success": False, "error": "Invalid after or limit value."}
+        return jsonify(res)
+    chunk = next(iter_newsletter_recipients(after, limit), [])
+    res = {
+        "recipients": chunk,
+        "checkpoint": chunk[-1]["user_id"] if chunk else after,
+        "has_more": len(chunk) == limit,
+    }
+    return jsonify(res)
+
+
+@app.route("/users/batch/", methods=["GET", "POST"])
+def users_batch():
+    """Displaying several users' info, looked up with a single IN query."""
+    try:
+        if request.method == "POST":
+            ids = user_ids_decoder.decode(request.get_data()).ids
+        else:
+            ids = [int(value) for value in request.args.get("ids", "").split(",")
+                   if value.strip()]
+            if len(ids) > USER_BATCH_MAX_IDS:
+                raise ValueError(f"At most {USER_BATCH_MAX_IDS} ids per request.")
+    except (ValueError, msgspec.DecodeError) as error:
+        res = {"success": False, "error": "Invalid id list.", "detail": str(error)}
+        return jsonify(res)
+    ids = list(dict.fromkeys(ids))
+    found = {}
+    for start in range(0, len(ids), SQLITE_MAX_PARAMS):
+        chunk = ids[start:start + SQLITE_MAX_PARAMS]
+        found.update((record.user_id, record)
+                     for record in users_by_ids(chunk))
+    results = {}
+    for user_id in ids:
+        record = found.get(user_id)
+        if record is None:
+            results[user_id] = {"success": False,
+                                "error": "User hasn't been found.", "user_id": user_id}
+        elif record.deleted:
+            results[user_id] = {"success": True,
+                                "error": "User has been deleted.", "user_id": user_id}
+        else:
+            results[user_id] = record.serialize
+    return jsonify(users=results)
+
+
 @app.route("/users/<int:user_id>/", methods=['GET'])
 def user(user_id):
     """Displaying user info."""
+    if wants_html():
+        user_record = user_by_id(user_id)
+        if user_record is None or user_record.deleted:
+            abort(404)
+        user_data = {name: getattr(user_record, name) for name in CARD_COLUMNS}
+        card = render_user_card(user_data)
+        return render_template("user.html", user=user_data, card=card)
     try:
-        data = User.query.filter_by(user_id=user_id).first()
+        data = user_by_id(user_id)
         if is_json(data.serialize):
             obj_dict = data.serialize
             if not obj_dict["deleted"]:
@@ -124,28 +2656,151 @@ def user(user_id):
         return jsonify(res)
 
 
+@app.route("/users/<int:user_id>/similar/", methods=["GET"])
+def similar(user_id):
+    """Listing likely duplicate accounts of a user."""
+    try:
+        threshold = float(request.args.get("threshold", SIMILARITY_THRESHOLD))
+        limit = int(request.args.get("limit", 20))
+        if not 0 < threshold <= 1 or limit < 1:
+            raise ValueError("threshold must be in (0, 1] and limit positive.")
+    except ValueError as error:
+        res = {"success": False, "error": "Invalid threshold or limit.",
+               "detail": str(error)}
+        return jsonify(res)
+    user_record = user_by_id(user_id)
+    if user_record is None or user_record.deleted:
+        res = {"success": False, "error": "User hasn't been found.", "user_id": user_id}
+        return jsonify(res)
+    matches = similar_users(user_record, threshold, limit)
+    return jsonify(user_id=user_id, similar=[
+        {"score": round(score, 3), "user": match.serialize} for score, match in matches])
+
+
+def duplicate_clusters(threshold=SIMILARITY_THRESHOLD):
+    """
+    Group live users into clusters of likely duplicates. Only pairs sharing
+    an LSH bucket are scored; buckets larger than SIMILARITY_MAX_CANDIDATES
+    (a name or address everyone shares) are skipped.
+    Returns {user_id: (cluster_id, best_score)}.
+    """
+    pairs = set()
+    buckets = db.session.execute(text(
+        'SELECT group_concat(user_id) FROM "UserSimilarityBand" GROUP BY band_key '
+        "HAVING COUNT(*) > 1 AND COUNT(*) <= :cap"),
+        {"cap": SIMILARITY_MAX_CANDIDATES}).scalars()
+    for members in buckets:
+        ids = sorted(int(value) for value in members.split(","))
+        pairs.update((first, second) for index, first in enumerate(ids)
+                     for second in ids[index + 1:])
+    involved = sorted({user_id for pair in pairs for user_id in pair})
+    shingles = {}
+    for start in range(0, len(involved), SQLITE_MAX_PARAMS):
+        for record in users_by_ids(involved[start:start + SQLITE_MAX_PARAMS]):
+            shingles[record.user_id] = similarity_shingles(
+                record.first_name, record.last_name, record.email)
+    parent = {}
+    best = {}
+
+    def root(user_id):
+        while parent.get(user_id, user_id) != user_id:
+            user_id = parent[user_id]
+        return user_id
+
+    for first, second in sorted(pairs):
+        if first not in shingles or second not in shingles:
+            continue
+        score = jaccard(shingles[first], shingles[second])
+        if score < threshold:
+            continue
+        for user_id in (first, second):
+            best[user_id] = max(best.get(user_id, 0.0), score)
+        first_root, second_root = root(first), root(second)
+        if first_root != second_root:
+            parent[max(first_root, second_root)] = min(first_root, second_root)
+    return {user_id: (root(user_id), score) for user_id, score in best.items()}
+
+
+@users_cli.command("duplicates")
+@click.option("--threshold", default=SIMILARITY_THRESHOLD, show_default=True,
+              type=click.FloatRange(0, 1, min_open=True),
+              help="Minimum Jaccard similarity of names and email.")
+@click.option("--output", "-o", type=click.File("w", encoding="utf-8"), default="-")
+@requires_schema
+def duplicates_command(threshold, output):
+    """Write a CSV report of likely duplicate accounts, one row per user."""
+    clusters = duplicate_clusters(threshold)
+    writer = csv.writer(output)
+    writer.writerow(["cluster", "user_id", "first_name", "last_name", "email", "score"])
+    ordered = sorted(clusters, key=lambda user_id: (clusters[user_id][0], user_id))
+    for start in range(0, len(ordered), SQLITE_MAX_PARAMS):
+        chunk = ordered[start:start + SQLITE_MAX_PARAMS]
+        records = {record.user_id: record for record in users_by_ids(chunk)}
+        for user_id in chunk:
+            record = records[user_id]
+            cluster, score = clusters[user_id]
+            writer.writerow([cluster, user_id, record.first_name, record.last_name,
+                             record.email, f"{score:.3f}"])
+    click.echo(f"{len(clusters)} users in {len(set(c for c, _ in clusters.values()))} "
+               "clusters.", err=True)
+
+
+def create_user_record(payload):
+    """Add a user from a validated payload and flush it; the caller commits."""
+    if email_registered(payload.email):
+        return {"success": False, "error": "Email address already registered."}
+    user_record = User(
+        first_name=payload.first_name, last_name=payload.last_name,
+        email=payload.email, password=payload.password
+    )
+    db.session.add(user_record)
+    db.session.flush()
+    return {"success": True, "user_id": user_record.user_id}
+
+
+def update_user_record(user_id, payload):
+    """Apply a validated payload to a user and flush it; the caller commits."""
+    existing_user = user_by_id(user_id)
+    if not existing_user:
+        return {"success": False, "error": "User hasn't been found."}
+    if existing_user.email != payload.email and email_registered(payload.email):
+        return {"success": False, "error": "Email already registered."}
+    existing_user.first_name = payload.first_name
+    existing_user.last_name = payload.last_name
+    existing_user.password = payload.password
+    existing_user.email = payload.email
+    db.session.flush()
+    return {"success": True, "message": "User data updated."}
+
+
+def delete_user_record(user_id):
+    """Soft delete a user and flush it; the caller commits."""
+    user_data = user_by_id(user_id)
+    if not user_data:
+        return {"success": False, "error": "User hasn't been found."}
+    user_data.deleted = True
+    db.session.flush()
+    return {"success": True, "message": "User has been deleted."}
+
+
 @app.route("/create/user/", methods=["POST"])
+@idempotent
 def create_user():
     """Creating user."""
     try:
-        data = request.get_json(force=True)
-        first_name = str(data["first_name"])
-        last_name = str(data["last_name"])
-        email = str(data["email"])
-        password = str(data["password"])
-        if User.query.filter_by(email=email).first():
-            res = {"success": False, "error": "Email address already registered."}
-            return jsonify(res)
-        user_record = User(
-            first_name=first_name, last_name=last_name, email=email, password=password
-        )
+        res = create_user_record(decode_user_payload())
         # Committing user.
-        db.session.add(user_record)
-        db.session.commit()
-        res = {"success": True}
+        if res["success"]:
+            db.session.commit()
         return jsonify(res)
-    except (KeyError, TypeError, ValueError):
-        res = {"success": False, "error": "Invalid JSON format. Missing value."}
+    except IntegrityError:
+        # Registered by another worker after our filter was built.
+        db.session.rollback()
+        res = {"success": False, "error": "Email address already registered."}
+        return jsonify(res)
+    except msgspec.DecodeError as error:
+        res = {"success": False, "error": "Invalid JSON format. Missing value.",
+               "detail": str(error)}
         return jsonify(res)
 
 
@@ -153,10 +2808,9 @@ def create_user():
 def delete_user(user_id):
     """Deleting user."""
     try:
-        user_data = User.query.get(user_id)
-        user_data.deleted = True
-        db.session.commit()
-        res = {"success": True, "message": "User has been deleted."}
+        res = delete_user_record(user_id)
+        if res["success"]:
+            db.session.commit()
         return jsonify(res)
     except (KeyError, TypeError, ValueError):
         res = {"success": False, "error": "Invalid JSON format or Missing id."}
@@ -164,36 +2818,465 @@ def delete_user(user_id):
 
 
 @app.route("/update/user/<int:user_id>/", methods=["POST"])
+@idempotent
 def update_user(user_id):
     """Updating user."""
     try:
-        data = request.get_json(force=True)
-        first_name = str(data["first_name"])
-        last_name = str(data["last_name"])
-        email = str(data["email"])
-        password = str(data["password"])
-        if existing_user := User.query.get(user_id):
-            if existing_user.email == email:
-                existing_user.first_name = first_name
-                existing_user.last_name = last_name
-                existing_user.password = password
-                db.session.commit()
-                res = {"success": True, "message": "User data updated."}
-            elif User.query.filter_by(email=email).first():
-                res = {"success": False, "error": "Email already registered."}
-            else:
-                existing_user.first_name = first_name
-                existing_user.last_name = last_name
-                existing_user.password = password
-                existing_user.email = email
-                db.session.commit()
-                res = {"success": True, "message": "User data updated."}
+        res = update_user_record(user_id, decode_user_payload())
+        if res["success"]:
+            db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        res = {"success": False, "error": "Email already registered."}
+    except msgspec.DecodeError as error:
+        res = {"success": False, "error": "Invalid JSON format or Missing value.",
+               "detail": str(error)}
+    return jsonify(res)
+
+
+def run_batch_operation(operation):
+    """Run one batch operation through the same helpers as its endpoint."""
+    if operation.op == "create":
+        return create_user_record(operation.data)
+    if operation.op == "update":
+        return update_user_record(operation.user_id, operation.data)
+    return delete_user_record(operation.user_id)
+
+
+@app.route("/batch/", methods=["POST"])
+@idempotent
+def batch():
+    """
+    Running several create, update and delete operations in one transaction.
+    In "atomic" mode the first failure rolls everything back; in "continue"
+    mode each operation has its own savepoint and the rest still commit.
+    """
+    try:
+        payload = batch_payload_decoder.decode(request.get_data())
+        for operation in payload.operations:
+            if operation.op != "create" and operation.user_id is None:
+                raise msgspec.ValidationError(f"{operation.op} requires a user_id.")
+            if operation.op != "delete" and operation.data is None:
+                raise msgspec.ValidationError(f"{operation.op} requires data.")
+    except msgspec.DecodeError as error:
+        res = {"success": False, "error": "Invalid batch format.", "detail": str(error)}
+        return jsonify(res)
+    # pysqlite only opens a transaction before DML; open it up front so the
+    # savepoints nest inside it instead of each one committing on release.
+    db.session.execute(text("BEGIN IMMEDIATE"))
+    results = []
+    failed = False
+    for operation in payload.operations:
+        if failed and payload.mode == "atomic":
+            results.append({"success": False,
+                            "error": "Skipped after an earlier failure."})
+            continue
+        savepoint = db.session.begin_nested()
+        try:
+            res = run_batch_operation(operation)
+        except IntegrityError:
+            res = {"success": False, "error": "Email address already registered."}
+        if res["success"]:
+            savepoint.commit()
         else:
-            res = {"success": False, "error": "User hasn't been found."}
-    except (KeyError, TypeError, ValueError):
-        res = {"success": False, "error": "Invalid JSON format or Missing value."}
+            savepoint.rollback()
+            failed = True
+        results.append(res)
+    if failed and payload.mode == "atomic":
+        db.session.rollback()
+        # Nothing committed, so no earlier success (or user_id) still holds.
+        results = [res if not res["success"] else
+                   {"success": False, "error": "Rolled back after an earlier failure."}
+                   for res in results]
+    else:
+        db.session.commit()
+    res = {"success": not failed, "mode": payload.mode, "results": results}
     return jsonify(res)
 
 
+job_handlers = {}
+audit_logger = logging.getLogger("lsdg.audit")
+
+
+def job_handler(kind):
+    """Register a function that runs a batch of payloads of one job kind."""
+    def register(function):
+        job_handlers[kind] = function
+        return function
+    return register
+
+
+@job_handler("audit_log")
+def audit_log_jobs(payloads):
+    """Write user changes to the audit log."""
+    for payload in payloads:
+        audit_logger.info("user %(user_id)s %(op)s (seq %(seq)s)", payload)
+
+
+@job_handler("welcome_email")
+def welcome_email_jobs(payloads):
+    """Greet newsletter subscribers. No mail backend is configured yet."""
+    for payload in payloads:
+        app.logger.info("Welcome email queued for %s", payload["email"])
+
+
+def job_backoff(attempts):
+    """Seconds until the next try: exponential with jitter, capped."""
+    return min(JOB_MAX_BACKOFF, 2 ** attempts) * random.uniform(0.5, 1.0)
+
+
+def claim_jobs(connection, limit):
+    """
+    Lease up to limit due jobs, including running ones whose lease expired
+    because their worker died.
+    """
+    now = time.time()
+    with connection.begin():
+        return connection.exec_driver_sql(
+            "UPDATE \"Job\" SET status = 'running', attempts = attempts + 1, "
+            "locked_until = ? WHERE job_id IN (SELECT job_id FROM \"Job\" "
+            "WHERE (status = 'queued' AND run_at <= ?) "
+            "OR (status = 'running' AND locked_until < ?) "
+            "ORDER BY run_at, job_id LIMIT ?) "
+            "RETURNING job_id, kind, payload, attempts",
+            (now + JOB_LEASE_SECONDS, now, now, limit)).all()
+
+
+def run_jobs(connection, jobs):
+    """Run claimed jobs batched by kind; retry or fail the batches that raise."""
+    by_kind = {}
+    for job in jobs:
+        by_kind.setdefault(job.kind, []).append(job)
+    for kind, batch in by_kind.items():
+        try:
+            handler = job_handlers[kind]
+            handler([json.loads(job.payload) for job in batch])
+        except Exception as error:  # A failing handler must not kill the worker.
+            app.logger.warning("Job batch %s failed: %s", kind, error)
+            now = time.time()
+            with connection.begin():
+                connection.exec_driver_sql(
+                    "UPDATE \"Job\" SET status = CASE WHEN attempts >= ? "
+                    "THEN 'failed' ELSE 'queued' END, run_at = ?, "
+                    "locked_until = NULL, last_error = ? WHERE job_id = ?",
+                    [(JOB_MAX_ATTEMPTS, now + job_backoff(job.attempts),
+                      repr(error), job.job_id) for job in batch])
+            continue
+        with connection.begin():
+            connection.exec_driver_sql('DELETE FROM "Job" WHERE job_id = ?',
+                                       [(job.job_id,) for job in batch])
+
+
+class JobWorker(threading.Thread):
+    """Thread that claims and runs job batches until stopped."""
+
+    def __init__(self, batch_size=JOB_BATCH_SIZE, poll_interval=JOB_POLL_INTERVAL):
+        super().__init__(daemon=True)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        with app.app_context(), db.engine.connect() as connection:
+            while not self.stopped.is_set():
+                try:
+                    jobs = claim_jobs(connection, self.batch_size)
+                    if jobs:
+                        run_jobs(connection, jobs)
+                        continue
+                except Exception:  # Keep polling through transient DB errors.
+                    app.logger.exception("Job worker iteration failed")
+                self.stopped.wait(self.poll_interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start_job_workers(count):
+    """Start count job worker threads and return them."""
+    workers = [JobWorker() for _ in range(count)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+@jobs_cli.command("work")
+@click.option("--threads", default=2, show_default=True)
+@click.option("--batch-size", default=JOB_BATCH_SIZE, show_default=True)
+@requires_schema
+def jobs_work_command(threads, batch_size):
+    """Run job workers in this process until interrupted."""
+    workers = [JobWorker(batch_size) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    click.echo(f"Running {threads} job workers; Ctrl+C stops them.")
+    try:
+        while any(worker.is_alive() for worker in workers):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.join()
+
+
+@jobs_cli.command("status")
+@requires_schema
+def jobs_status_command():
+    """Count jobs by kind and status."""
+    rows = db.session.execute(
+        select(Job.kind, Job.status, db.func.count())
+        .group_by(Job.kind, Job.status).order_by(Job.kind, Job.status)).all()
+    for kind, status, count in rows:
+        click.echo(f"{kind:<16} {status:<8} {count:,}")
+    if not rows:
+        click.echo("No jobs queued.")
+
+
+@jobs_cli.command("retry-failed")
+@requires_schema
+def jobs_retry_command():
+    """Queue failed jobs again with a fresh attempt count."""
+    updated = db.session.execute(
+        Job.__table__.update().where(Job.status == "failed")
+        .values(status="queued", attempts=0, run_at=time.time())).rowcount
+    db.session.commit()
+    click.echo(f"Requeued {updated:,} jobs.")
+
+
+def database_path():
+    """Filesystem path of the SQLite database the app is bound to."""
+    return db.engine.url.database
+
+
+def create_backup(directory=BACKUP_DIR, method="backup"):
+    """
+    Snapshot the live database without stalling request connections.
+    The database is kept in WAL mode, where a read transaction sees a
+    fixed snapshot while writers keep committing to the log. Both methods
+    copy under one such transaction: "backup" with SQLite's online backup
+    API in a single step, "vacuum" with VACUUM INTO, which also compacts.
+    A stepwise backup would restart whenever another connection writes,
+    so it is not offered. The snapshot is written under a temporary name
+    and linked into place once complete, never over an existing snapshot.
+    """
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(database_path()))[0]
+    target = os.path.join(directory, f"{stem}-{datetime.now():%Y%m%d-%H%M%S-%f}.db")
+    partial = f"{target}.{os.getpid()}.partial"
+    if os.path.exists(partial):
+        os.remove(partial)
+    source = sqlite3.connect(database_path(), timeout=30)
+    try:
+        mode = source.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        if mode != "wal":
+            raise click.ClickException(
+                f"The database is in {mode} journal mode; a snapshot would block "
+                "writers for the whole copy.")
+        if method == "vacuum":
+            source.execute("VACUUM INTO ?", (partial,))
+        else:
+            destination = sqlite3.connect(partial)
+            try:
+                source.backup(destination)
+                # A standalone file; don't leave it expecting a -wal beside it.
+                destination.execute("PRAGMA journal_mode = DELETE")
+            finally:
+                destination.close()
+    finally:
+        source.close()
+    try:
+        os.link(partial, target)
+    except FileExistsError as error:
+        raise click.ClickException(f"Snapshot {target} already exists.") from error
+    finally:
+        os.remove(partial)
+    return target
+
+
+def check_backup(path, full=False):
+    """Run an integrity check on a snapshot, returning SQLite's messages."""
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        pragma = "integrity_check" if full else "quick_check"
+        return [row[0] for row in connection.execute(f"PRAGMA {pragma}")]
+    finally:
+        connection.close()
+
+
+def rotate_backups(directory=BACKUP_DIR, keep=BACKUP_KEEP):
+    """Delete all but the newest keep snapshots of this database."""
+    stem = os.path.splitext(os.path.basename(database_path()))[0]
+    snapshots = sorted(name for name in os.listdir(directory)
+                       if name.startswith(stem + "-") and name.endswith(".db"))
+    removed = snapshots[:-keep] if keep else []
+    for name in removed:
+        os.remove(os.path.join(directory, name))
+    return removed
+
+
+def run_backup(directory, method, keep, full_check, echo):
+    """Snapshot, verify and rotate; a snapshot failing its check is discarded."""
+    path = create_backup(directory, method)
+    problems = check_backup(path, full_check)
+    if problems != ["ok"]:
+        os.replace(path, path + ".corrupt")
+        raise click.ClickException(f"Snapshot failed its integrity check: {problems}")
+    echo(f"Backup written to {path}.")
+    for name in rotate_backups(directory, keep):
+        echo(f"Removed old snapshot {name}.")
+    return path
+
+
+def backup_options(command):
+    """Options shared by the backup commands."""
+    options = [
+        click.option("--dir", "directory", default=BACKUP_DIR, show_default=True,
+                     type=click.Path(file_okay=False)),
+        click.option("--method", type=click.Choice(["backup", "vacuum"]),
+                     default="backup", show_default=True),
+        click.option("--keep", default=BACKUP_KEEP, show_default=True,
+                     help="Snapshots to keep; 0 keeps all."),
+        click.option("--full-check", is_flag=True,
+                     help="Run integrity_check instead of quick_check."),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+@backup_cli.command("create")
+@backup_options
+def backup_create_command(directory, method, keep, full_check):
+    """Take one verified snapshot and rotate old ones."""
+    run_backup(directory, method, keep, full_check, click.echo)
+
+
+@backup_cli.command("schedule")
+@backup_options
+@click.option("--interval", default=3600, show_default=True,
+              help="Seconds between snapshots.")
+def backup_schedule_command(directory, method, keep, full_check, interval):
+    """Take snapshots every --interval seconds until interrupted."""
+    while True:
+        started = time.monotonic()
+        try:
+            run_backup(directory, method, keep, full_check, click.echo)
+        except (click.ClickException, sqlite3.Error, OSError) as error:
+            click.echo(f"Backup failed: {error}", err=True)
+        time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+
+@backup_cli.command("verify")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--full-check", is_flag=True)
+def backup_verify_command(path, full_check):
+    """Integrity check a snapshot."""
+    problems = check_backup(path, full_check)
+    if problems != ["ok"]:
+        raise click.ClickException("\n".join(problems))
+    click.echo("ok")
+
+
+def default_worker_count():
+    """Worker processes for this host: one per usable core."""
+    if hasattr(os, "sched_getaffinity"):
+        return max(1, len(os.sched_getaffinity(0)))
+    return os.cpu_count() or 1
+
+
+def default_thread_count(workers):
+    """
+    Threads per worker, so the host runs SERVE_THREADS_PER_CORE threads per
+    core in total: requests spend most of their time waiting on SQLite and
+    clients, which threads overlap.
+    """
+    return max(2, SERVE_THREADS_PER_CORE * default_worker_count() // workers)
+
+
+@app.cli.command("serve")
+@click.option("--bind", default="0.0.0.0:8000", show_default=True)
+@click.option("--workers", type=int, default=None,
+              help="Worker processes, one per core by default.")
+@click.option("--threads", type=int, default=None,
+              help="Threads per worker, sized to the cores per worker by default.")
+@click.option("--keepalive", default=5, show_default=True,
+              help="Seconds to hold idle keep-alive connections.")
+@click.option("--backlog", default=2048, show_default=True,
+              help="Pending connections the listen socket queues.")
+@click.option("--timeout", default=30, show_default=True,
+              help="Seconds before a silent worker is killed and replaced.")
+@click.option("--graceful-timeout", default=30, show_default=True,
+              help="Seconds workers get to finish requests on reload or stop.")
+@click.option("--max-requests", default=10000, show_default=True,
+              help="Recycle a worker after this many requests (0 disables).")
+def serve_command(bind, workers, threads, keepalive, backlog, timeout,
+                  graceful_timeout, max_requests):
+    """
+    Serve the app in production with gunicorn's threaded workers.
+    The app is preloaded once and forked, so caches built at startup are
+    shared; send SIGHUP to reload workers gracefully.
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError as error:
+        raise click.ClickException("flask serve requires gunicorn.") from error
+
+    def post_fork(server, worker):
+        # Connections opened while preloading must not be shared across forks.
+        with app.app_context():
+            db.engine.dispose(close=False)
+        if app.config["JOB_WORKER_THREADS"]:
+            start_job_workers(app.config["JOB_WORKER_THREADS"])
+
+    global idempotency_store
+    workers = workers or default_worker_count()
+    threads = threads or default_thread_count(workers)
+    if workers > 1 and "IDEMPOTENCY_BACKEND" not in os.environ:
+        # A retry can land on any worker, so keys must be shared between them.
+        app.config["IDEMPOTENCY_BACKEND"] = "sqlite"
+        idempotency_store = make_idempotency_store("sqlite")
+    options = {
+        "bind": bind,
+        "workers": workers,
+        "worker_class": "gthread",
+        "threads": threads,
+        "keepalive": keepalive,
+        "backlog": backlog,
+        "timeout": timeout,
+        "graceful_timeout": graceful_timeout,
+        "max_requests": max_requests,
+        "max_requests_jitter": max_requests // 10,
+        "preload_app": True,
+        "post_fork": post_fork,
+    }
+    # Inherited by the forked workers, whose gthread pools have this many threads.
+    thread_reserve.limit = max(1, threads - ADMISSION_RESERVED_THREADS)
+    # Built once here, the filter's pages are shared copy-on-write by every worker.
+    with app.app_context():
+        try:
+            ensure_schema()
+        except SchemaNotReady as error:
+            raise click.ClickException(str(error)) from error
+        ensure_email_filter()
+
+    class ProductionServer(BaseApplication):
+        """Gunicorn application wrapping this module's app."""
+
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    ProductionServer().run()
+
+
 if __name__ == "__main__":
+    # The reloader re-runs this module in a child process; only that one serves.
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true" and app.config["JOB_WORKER_THREADS"]:
+        with app.app_context():
+            ensure_schema()
+        start_job_workers(app.config["JOB_WORKER_THREADS"])
     app.run(debug=True)
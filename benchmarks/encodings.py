@@ -0,0 +1,70 @@
+"""
+Encode and decode cost of a /users/ payload as JSON, MessagePack and CBOR.
+
+Runs against a throwaway SQLite file so main.db is never touched:
+
+    python benchmarks/encodings.py --users 5000 --repeat 20
+
+CBOR rows are skipped unless cbor2 is installed.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def best_of(repeat, function, value):
+    """Fastest of repeat calls, in milliseconds, and the last result."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(value)
+        best = min(best, time.perf_counter() - started)
+    return best * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(workdir, "bench.db")
+    sys.path.insert(0, ROOT)
+    import msgspec
+    from app import BINARY_ENCODERS, User, app, cbor2, db, ensure_schema
+
+    with app.app_context():
+        ensure_schema()
+        db.session.execute(User.__table__.insert(), [
+            {"first_name": f"First{i}", "last_name": f"Last{i}",
+             "email": f"user{i}@example.com", "password": "secret"}
+            for i in range(args.users)
+        ])
+        db.session.commit()
+        payload = {"users": [user.serialize for user in User.query.all()]}
+
+        # Production responses are compact, as jsonify() sends them outside debug.
+        formats = [("json", lambda obj: app.json.dumps(obj, separators=(",", ":")),
+                    json.loads),
+                   ("msgpack", BINARY_ENCODERS["application/msgpack"],
+                    msgspec.msgpack.decode)]
+        if cbor2 is not None:
+            formats.append(("cbor", BINARY_ENCODERS["application/cbor"], cbor2.loads))
+
+        print(f"{args.users:,} users, best of {args.repeat}")
+        print(f"{'format':<10} {'encode ms':>10} {'decode ms':>10} {'bytes':>12}")
+        for name, encode, decode in formats:
+            encode_ms, body = best_of(args.repeat, encode, payload)
+            decode_ms, _ = best_of(args.repeat, decode, body)
+            print(f"{name:<10} {encode_ms:>10.2f} {decode_ms:>10.2f} {len(body):>12,}")
+
+
+if __name__ == "__main__":
+    main()
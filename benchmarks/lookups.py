@@ -0,0 +1,69 @@
+"""
+Per-lookup overhead of the ORM query API versus the prebuilt statements.
+
+Runs against a throwaway SQLite file so main.db is never touched:
+
+    python benchmarks/lookups.py --users 10000 --lookups 20000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(label, lookup, keys):
+    """Run lookup over keys and print the mean cost per call."""
+    started = time.perf_counter()
+    for key in keys:
+        lookup(key)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<42} {elapsed / len(keys) * 1e6:8.1f} us/lookup")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--lookups", type=int, default=20000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(workdir, "bench.db")
+    sys.path.insert(0, ROOT)
+    from app import User, app, db, ensure_schema, user_by_id, user_id_by_email
+
+    with app.app_context():
+        ensure_schema()
+        db.session.execute(User.__table__.insert(), [
+            {"first_name": f"First{i}", "last_name": f"Last{i}",
+             "email": f"user{i}@example.com", "password": "secret"}
+            for i in range(args.users)
+        ])
+        db.session.commit()
+        ids = [random.randint(1, args.users) for _ in range(args.lookups)]
+        emails = [f"user{i - 1}@example.com" for i in ids]
+
+        def orm_by_id(user_id):
+            return User.query.filter_by(user_id=user_id).first()
+
+        def orm_by_email(email):
+            return db.session.query(User.user_id).filter_by(email=email).first()
+
+        # Warm both paths so the first compile isn't counted.
+        orm_by_id(1), user_by_id(1), orm_by_email(emails[0]), user_id_by_email(emails[0])
+        print(f"{args.users:,} users, {args.lookups:,} lookups per path")
+        before = measure("by id, Query.filter_by().first()", orm_by_id, ids)
+        after = measure("by id, user_by_id() prebuilt statement", user_by_id, ids)
+        print(f"{'':<42} {before / after:8.2f}x")
+        before = measure("by email, Query.filter_by().first()", orm_by_email, emails)
+        after = measure("by email, user_id_by_email() prebuilt", user_id_by_email, emails)
+        print(f"{'':<42} {before / after:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
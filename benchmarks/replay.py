@@ -0,0 +1,118 @@
+"""
+Re-drive a request capture against a running instance and report latencies.
+
+Capture real traffic first, then replay it against a local server:
+
+    REQUEST_CAPTURE_RATE=0.1 flask serve
+    python benchmarks/replay.py capture.ndjson --base-url http://127.0.0.1:8000 --speed 2
+
+Requests are sent on the capture's own schedule, compressed by --speed
+(0 sends them back to back). Latency is measured from each request's
+scheduled send time, so a server that falls behind shows up as queueing
+instead of being hidden by a slower send rate.
+"""
+
+import argparse
+import json
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def load_capture(path, limit=None):
+    """Read capture records in send order."""
+    with open(path, encoding="utf-8") as capture:
+        records = [json.loads(line) for line in capture if line.strip()]
+    records.sort(key=lambda record: record["t"])
+    return records[:limit] if limit else records
+
+
+def send(base_url, record, scheduled, timeout):
+    """Send one captured request; return (status, latency from schedule in ms)."""
+    body = record.get("body")
+    req = urllib.request.Request(
+        base_url.rstrip("/") + record["path"], method=record["method"],
+        data=body.encode() if body is not None else None,
+        headers=record.get("headers", {}))
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as error:
+        error.read()
+        status = error.code
+    except (urllib.error.URLError, OSError):
+        status = "error"
+    return status, (time.perf_counter() - scheduled) * 1000
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def report(label, replayed, captured):
+    """Print one row of replayed latencies next to the captured service times."""
+    replayed.sort()
+    captured.sort()
+    print(f"{label:<28} {len(replayed):>7} "
+          f"{percentile(replayed, 0.5):>8.1f} {percentile(replayed, 0.9):>8.1f} "
+          f"{percentile(replayed, 0.99):>8.1f} {replayed[-1]:>8.1f} "
+          f"{percentile(captured, 0.5):>9.1f} {percentile(captured, 0.99):>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("capture")
+    parser.add_argument("--base-url", default="http://127.0.0.1:5000")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay rate relative to capture; 0 means no delays.")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--limit", type=int, help="Replay only the first N requests.")
+    args = parser.parse_args()
+
+    records = load_capture(args.capture, args.limit)
+    if not records:
+        parser.error("capture is empty")
+    first = records[0]["t"]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        futures = []
+        for record in records:
+            offset = (record["t"] - first) / args.speed if args.speed else 0.0
+            scheduled = started + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append((record, pool.submit(send, args.base_url, record,
+                                                scheduled, args.timeout)))
+        results = [(record, future.result()) for record, future in futures]
+    elapsed = time.perf_counter() - started
+
+    by_endpoint = {}
+    statuses = {}
+    for record, (status, latency) in results:
+        label = f"{record['method']} {record.get('endpoint') or record['path']}"
+        replayed, captured = by_endpoint.setdefault(label, ([], []))
+        replayed.append(latency)
+        captured.append(record["ms"])
+        statuses[status] = statuses.get(status, 0) + 1
+
+    print(f"{len(results):,} requests in {elapsed:.1f}s "
+          f"({len(results) / elapsed:.0f} req/s), speed {args.speed or 'max'}x")
+    print(f"{'endpoint':<28} {'count':>7} {'p50 ms':>8} {'p90 ms':>8} "
+          f"{'p99 ms':>8} {'max ms':>8} {'cap p50':>9} {'cap p99':>9}")
+    for label in sorted(by_endpoint):
+        report(label, *by_endpoint[label])
+    report("all", [latency for _, (_, latency) in results],
+           [record["ms"] for record, _ in results])
+    print("statuses: " + ", ".join(f"{status}={count}" for status, count
+                                   in sorted(statuses.items(), key=str)))
+
+
+if __name__ == "__main__":
+    main()
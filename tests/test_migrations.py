@@ -0,0 +1,134 @@
+"""Online table rebuild: interrupted mid-copy, resumed, with concurrent writes."""
+
+import os
+import sqlite3
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATABASE = os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ["DATABASE_URL"] = "sqlite:///" + DATABASE
+sys.path.insert(0, ROOT)
+
+from app import (  # noqa: E402
+    Migration, MigrationRunner, RebuildTable, User, app, ensure_schema,
+)
+
+USERS = 2000
+BATCH_SIZE = 100
+
+
+class Interrupted(Exception):
+    """Stands in for the runner process dying between batches."""
+
+
+class WritingRunner(MigrationRunner):
+    """
+    Lets a second connection write between batches, as the app would, and
+    optionally dies after a number of batches.
+    """
+
+    def __init__(self, writer, fail_after=None):
+        super().__init__(BATCH_SIZE)
+        self.writer = writer
+        self.fail_after = fail_after
+        self.batches = 0
+
+    def pause(self):
+        self.batches += 1
+        self.writer.step(self.batches)
+        if self.fail_after is not None and self.batches >= self.fail_after:
+            raise Interrupted()
+
+
+class Writer:
+    """Inserts, updates and deletes users on its own connection, tracking the result."""
+
+    def __init__(self, rows):
+        self.connection = sqlite3.connect(DATABASE, timeout=30, isolation_level=None)
+        self.rows = rows
+        self.next_id = max(rows) + 1
+        self.live_index_names = []
+
+    def step(self, batch):
+        self.live_index_names.append(index_names(self.connection, "User"))
+        user_id = self.next_id
+        self.next_id += 1
+        self.connection.execute(
+            'INSERT INTO "User" (user_id, first_name, last_name, email, password, '
+            "newsletter, subscription_id, created, updated_at, deleted, change_seq) "
+            "VALUES (?, ?, 'New', ?, 'pw', 0, 1, '2024-01-01 00:00:00', "
+            "'2024-01-01 00:00:00', 0, 0)", (user_id, f"New{user_id}", f"new{user_id}@x.com"))
+        self.rows[user_id] = (f"New{user_id}", f"new{user_id}@x.com")
+        # Rows on both sides of the copy checkpoint.
+        for target in (batch * 7 % USERS + 1, USERS - batch * 11 % USERS):
+            if target in self.rows:
+                self.connection.execute('UPDATE "User" SET first_name = ? '
+                                        "WHERE user_id = ?", (f"Edited{batch}", target))
+                self.rows[target] = (f"Edited{batch}", self.rows[target][1])
+        doomed = batch * 13 % USERS + 1
+        self.connection.execute('DELETE FROM "User" WHERE user_id = ?', (doomed,))
+        self.rows.pop(doomed, None)
+
+
+def index_names(connection, table):
+    return sorted(name for (name,) in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? "
+        "AND sql IS NOT NULL", (table,)))
+
+
+@pytest.fixture
+def users():
+    with app.app_context():
+        ensure_schema()
+    connection = sqlite3.connect(DATABASE, isolation_level=None)
+    connection.executemany(
+        'INSERT INTO "User" (user_id, first_name, last_name, email, password, '
+        "newsletter, subscription_id, created, updated_at, deleted, change_seq) "
+        "VALUES (?, ?, 'Last', ?, 'pw', 0, 1, '2024-01-01 00:00:00', "
+        "'2024-01-01 00:00:00', 0, 0)",
+        [(user_id, f"First{user_id}", f"user{user_id}@x.com")
+         for user_id in range(1, USERS + 1)])
+    connection.close()
+    return {user_id: (f"First{user_id}", f"user{user_id}@x.com")
+            for user_id in range(1, USERS + 1)}
+
+
+def test_rebuild_resumes_after_interruption_under_writes(users):
+    model_indexes = sorted(index.name for index in User.__table__.indexes)
+    writer = Writer(users)
+    migration = Migration("test_rebuild_user", [RebuildTable(User.__table__)])
+    with app.app_context():
+        with pytest.raises(Interrupted):
+            WritingRunner(writer, fail_after=5).run([migration])
+        connection = writer.connection
+        # fetchall() ends the read; an open statement would keep the writer's
+        # next autocommit write from committing.
+        [(checkpoint,)] = connection.execute(
+            'SELECT checkpoint FROM "SchemaMigration" WHERE name = ?',
+            (migration.name,)).fetchall()
+        assert 0 < checkpoint < USERS
+        assert index_names(connection, "User__rebuild") == [
+            f"{name}__rebuild" for name in model_indexes]
+
+        WritingRunner(writer).run([migration])
+
+    # The live table kept its indexes for the whole copy.
+    assert all(names == model_indexes for names in writer.live_index_names)
+    assert index_names(connection, "User") == model_indexes
+    assert connection.execute(
+        "SELECT name FROM sqlite_master WHERE name LIKE '%__rebuild%' "
+        "OR name LIKE '%__retired%'").fetchall() == []
+    assert connection.execute(
+        'SELECT completed_at IS NOT NULL FROM "SchemaMigration" WHERE name = ?',
+        (migration.name,)).fetchall() == [(1,)]
+    rows = {user_id: (first_name, email) for user_id, first_name, email in
+            connection.execute('SELECT user_id, first_name, email FROM "User"')}
+    assert rows == writer.rows
+    plan = connection.execute(
+        'EXPLAIN QUERY PLAN SELECT user_id FROM "User" WHERE deleted = 0 '
+        "ORDER BY created").fetchall()
+    assert "ix_User_deleted_created" in plan[0][3]
+    assert connection.execute("PRAGMA integrity_check").fetchall() == [("ok",)]